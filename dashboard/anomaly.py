@@ -0,0 +1,177 @@
+import math
+import pandas as pd
+
+SENTIMENT_METRICS = ('positive_count', 'negative_count', 'compound_mean')
+
+
+class EWMAZScore:
+    """
+    Exponentially weighted mean and variance of a stream.
+
+    `update` returns the z-score of the new value against the statistics of
+    the previous values, then folds the value in. O(1) time and memory.
+
+    Parameters
+    ----------
+    alpha : float, optional
+        Weight of the newest value. Defaults to 0.1 (about 20 values of memory).
+    warmup : int, optional
+        Number of values seen before z-scores are returned. Defaults to 12.
+    """
+
+    def __init__(self, alpha:float=0.1, warmup:int=12):
+        self.alpha = alpha
+        self.warmup = warmup
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def update(self, value:float):
+        zscore = None
+        if self.count >= self.warmup and self.var > 0:
+            zscore = (value - self.mean) / math.sqrt(self.var)
+        if self.count == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            increment = self.alpha * diff
+            self.mean += increment
+            self.var = (1 - self.alpha) * (self.var + diff * increment)
+        self.count += 1
+        return zscore
+
+
+class CUSUM:
+    """
+    Two-sided CUSUM over standardized values.
+
+    Accumulates the deviations larger than `k` standard deviations and
+    signals a persistent shift when a sum exceeds `h`, then restarts.
+
+    Parameters
+    ----------
+    k : float, optional
+        Allowed slack, in standard deviations. Defaults to 0.5.
+    h : float, optional
+        Decision threshold. Defaults to 5.
+    """
+
+    def __init__(self, k:float=0.5, h:float=5.0):
+        self.k = k
+        self.h = h
+        self.upper = 0.0
+        self.lower = 0.0
+
+    def update(self, zscore:float):
+        """Return 'up' or 'down' when a shift is detected, None otherwise"""
+        self.upper = max(0.0, self.upper + zscore - self.k)
+        self.lower = max(0.0, self.lower - zscore - self.k)
+        if self.upper > self.h:
+            self.upper = self.lower = 0.0
+            return 'up'
+        if self.lower > self.h:
+            self.upper = self.lower = 0.0
+            return 'down'
+        return None
+
+
+class MetricMonitor:
+    """Spike (z-score above `threshold`) and shift (CUSUM) detection for one metric"""
+
+    def __init__(self, metric:str, threshold:float=3.0, alpha:float=0.1, warmup:int=12, k:float=0.5, h:float=5.0):
+        self.metric = metric
+        self.threshold = threshold
+        self.ewma = EWMAZScore(alpha, warmup)
+        self.cusum = CUSUM(k, h)
+
+    def update(self, date, value:float):
+        """Fold `value` in and return the alert events it raised"""
+        if value is None or pd.isna(value):
+            return []
+        zscore = self.ewma.update(float(value))
+        if zscore is None:
+            return []
+        events = []
+        if abs(zscore) >= self.threshold:
+            events.append(self._event(date, value, zscore, 'zscore', 'up' if zscore > 0 else 'down'))
+        # Clip so a single spike does not also trip the CUSUM on its own
+        direction = self.cusum.update(max(-self.threshold, min(self.threshold, zscore)))
+        if direction is not None:
+            events.append(self._event(date, value, zscore, 'cusum', direction))
+        return events
+
+    def _event(self, date, value, zscore, detector, direction):
+        return {
+            'date': pd.to_datetime(date),
+            'metric': self.metric,
+            'value': float(value),
+            'zscore': round(zscore, 2),
+            'detector': detector,
+            'direction': direction,
+        }
+
+
+class AnomalyDetector:
+    """
+    Online anomaly detection on the dashboard aggregates.
+
+    Keeps one `MetricMonitor` per sentiment metric (see `SENTIMENT_METRICS`)
+    and one on the Bitcoin price log returns. Feed each new aggregate as it
+    arrives; the detector only keeps constant-size state per metric.
+
+    Parameters
+    ----------
+    threshold : float, optional
+        Absolute z-score from which a value is a spike. Defaults to 3.
+    alpha, warmup, k, h : optional
+        Settings of `EWMAZScore` and `CUSUM`.
+    """
+
+    def __init__(self, threshold:float=3.0, alpha:float=0.1, warmup:int=12, k:float=0.5, h:float=5.0):
+        settings = dict(threshold=threshold, alpha=alpha, warmup=warmup, k=k, h=h)
+        self.monitors = {metric: MetricMonitor(metric, **settings) for metric in SENTIMENT_METRICS}
+        self.monitors['price_return'] = MetricMonitor('price_return', **settings)
+        self.last_price = None
+        self.last_sentiment_date = None
+        self.last_price_date = None
+
+    def update_sentiment(self, row):
+        """Fold one row of sentiment counts (as returned by `comments2count` plus 'date')"""
+        date = pd.to_datetime(row['date'])
+        if self.last_sentiment_date is not None and date <= self.last_sentiment_date:
+            return []
+        self.last_sentiment_date = date
+        events = []
+        for metric in SENTIMENT_METRICS:
+            events += self.monitors[metric].update(date, row[metric])
+        return events
+
+    def update_price(self, date, price:float):
+        """Fold one Bitcoin price, alerts are raised on its log return"""
+        date = pd.to_datetime(date)
+        if self.last_price_date is not None and date <= self.last_price_date:
+            return []
+        self.last_price_date = date
+        events = []
+        if self.last_price is not None and self.last_price > 0 and price > 0:
+            events = self.monitors['price_return'].update(date, math.log(price / self.last_price))
+        self.last_price = price
+        return events
+
+    def update_sentiments(self, df:pd.DataFrame):
+        """Fold every row of `df`, oldest first, and return all the events"""
+        events = []
+        if df is None or df.empty:
+            return events
+        for _, row in df.sort_values('date').iterrows():
+            events += self.update_sentiment(row)
+        return events
+
+    def update_prices(self, df:pd.DataFrame, column:str='bitcoin'):
+        """Fold every price of `df`, oldest first, and return all the events"""
+        events = []
+        if df is None or df.empty:
+            return events
+        for _, row in df.sort_values('date').iterrows():
+            events += self.update_price(row['date'], row[column])
+        return events
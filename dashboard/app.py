@@ -5,6 +5,7 @@ import dash_bootstrap_components as dbc
 from dash import dcc, html
 from dash.dependencies import Input, Output
 import plotly.graph_objs as go
+import threading
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 import logging
@@ -14,8 +15,12 @@ from utils import (
     fetch_initial_reddit_comments,
     fetch_new_bitcoin_data,
     fetch_new_reddit_data,
-    send_whatsapp_rebit_message
+    enqueue_rebit_message,
+    enqueue_anomaly_alerts,
+    anomaly_alert_id
 )
+from anomaly import AnomalyDetector
+from notifications import NotificationQueue, NotificationDispatcher
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -34,23 +39,121 @@ server = app.server
 BUCKET_NAME = 'bucket-iot-sentiment-analysis'
 HOURS = 12
 
-# Data cache
+# Data cache, shared by the callback threads of a worker. Each dataset is
+# refreshed under its lock at most every REFRESH_SECONDS; while one thread
+# refreshes, the callbacks of the other viewers render the current snapshot
+# instead of waiting (they only wait for the first load)
+REFRESH_SECONDS = 30
 bitcoin_data = pd.DataFrame()
 reddit_data = pd.DataFrame()
+bitcoin_lock = threading.Lock()
+reddit_lock = threading.Lock()
+alerts_lock = threading.Lock()
+last_refresh = {'bitcoin': None, 'reddit': None}
 
-def update_graph(n):
+def needs_refresh(name:str):
+    last = last_refresh[name]
+    return last is None or (datetime.utcnow() - last).total_seconds() >= REFRESH_SECONDS
+
+# Notifications go through a durable queue shared by the workers, a single
+# leader among them delivers
+notification_queue = NotificationQueue()
+dispatcher = NotificationDispatcher(notification_queue)
+dispatcher.start()
+
+# Online anomaly detection, fed by a scheduler job polling the manifests
+# whether or not anyone views the dashboard. Only the worker holding the
+# dispatcher lease detects, and stores the alerts in the queue database;
+# every worker reloads them into `alerts`, read by the callbacks for the
+# graph annotations
+ANOMALY_POLL_SECONDS = int(os.getenv('ANOMALY_POLL_SECONDS', 60))
+detector = AnomalyDetector()
+alerts = []
+# Last prices and sentiments folded into the detector, None before the warm-up
+detector_last = {'bitcoin': None, 'reddit': None}
+
+def record_alerts(events, notify:bool=True):
+    notification_queue.add_alerts([{**event, 'alert_id': anomaly_alert_id(event)} for event in events])
+    if notify:
+        enqueue_anomaly_alerts(notification_queue, events)
+
+def load_alerts():
+    global alerts
+    since = datetime.utcnow() - timedelta(hours=HOURS)
+    recent = notification_queue.recent_alerts(since)
+    with alerts_lock:
+        alerts = recent
+
+def detect_anomalies():
+    """Fold the prices and sentiments written since the last run into the detector, on the leader only"""
+    global detector
+    if dispatcher.is_leader():
+        update_detector()
+    elif detector_last['bitcoin'] is not None or detector_last['reddit'] is not None:
+        # Warm up again from the current history if this worker takes the lead later
+        detector = AnomalyDetector()
+        detector_last.update(bitcoin=None, reddit=None)
+    load_alerts()
+
+def update_detector():
+    warmup = detector_last['bitcoin'] is None
+    prices = fetch_initial_bitcoin_data(HOURS) if warmup else fetch_new_bitcoin_data(detector_last['bitcoin'])
+    # The history only warms the detector up, without sending messages
+    record_alerts(detector.update_prices(prices), notify=not warmup)
+    if warmup or not prices.empty:
+        detector_last['bitcoin'] = prices
+
+    warmup = detector_last['reddit'] is None
+    sentiments = fetch_initial_reddit_comments(HOURS) if warmup else fetch_new_reddit_data(detector_last['reddit'])
+    record_alerts(detector.update_sentiments(sentiments), notify=not warmup)
+    if warmup or not sentiments.empty:
+        detector_last['reddit'] = sentiments
+
+def add_alert_annotations(fig, metrics, since):
+    for event in alerts:
+        if event['metric'] in metrics and event['date'] >= since:
+            fig.add_vline(
+                x=event['date'],
+                line=dict(color='orange' if event['detector'] == 'cusum' else 'crimson', dash='dot')
+            )
+            # Separate annotation, add_vline cannot place its text on a datetime axis
+            fig.add_annotation(
+                x=event['date'], y=1, yref='paper', showarrow=False,
+                text=f"{event['metric']} {event['direction']}",
+                font=dict(size=10)
+            )
+    return fig
+
+def acquire_refresh_lock(lock:threading.Lock, snapshot:pd.DataFrame):
+    """Take `lock` without waiting, unless there is no snapshot to render yet"""
+    return lock.acquire(blocking=snapshot.empty)
+
+def refresh_bitcoin_data():
     global bitcoin_data
-    if bitcoin_data.empty:
-        bitcoin_data = fetch_initial_bitcoin_data(HOURS)
+    if not needs_refresh('bitcoin') or not acquire_refresh_lock(bitcoin_lock, bitcoin_data):
+        return bitcoin_data
+    try:
+        if not needs_refresh('bitcoin'):
+            return bitcoin_data
+        if bitcoin_data.empty:
+            bitcoin_data = fetch_initial_bitcoin_data(HOURS)
 
-    new_data = fetch_new_bitcoin_data(bitcoin_data)
-    if new_data is not None and not new_data.empty:
-        bitcoin_data = pd.concat([bitcoin_data, new_data], ignore_index=True)
-        bitcoin_data = bitcoin_data.drop_duplicates(subset=['date']).sort_values('date')
+        new_data = fetch_new_bitcoin_data(bitcoin_data)
+        if new_data is not None and not new_data.empty:
+            bitcoin_data = pd.concat([bitcoin_data, new_data], ignore_index=True)
+            bitcoin_data = bitcoin_data.drop_duplicates(subset=['date']).sort_values('date')
 
-    now = datetime.utcnow()
-    twelve_hours_ago = now - timedelta(hours=HOURS)
-    bitcoin_data = bitcoin_data[bitcoin_data['date'] >= twelve_hours_ago]
+        if not bitcoin_data.empty:
+            twelve_hours_ago = datetime.utcnow() - timedelta(hours=HOURS)
+            bitcoin_data = bitcoin_data[bitcoin_data['date'] >= twelve_hours_ago]
+        last_refresh['bitcoin'] = datetime.utcnow()
+        return bitcoin_data
+    finally:
+        bitcoin_lock.release()
+
+def update_graph(n):
+    bitcoin_data = refresh_bitcoin_data()
+    twelve_hours_ago = datetime.utcnow() - timedelta(hours=HOURS)
 
     if bitcoin_data.empty:
         return go.Figure().update_layout(title="No data available")
@@ -63,6 +166,7 @@ def update_graph(n):
         name='Bitcoin Price',
         line=dict(color='blue')
     ))
+    add_alert_annotations(fig, ['price_return'], twelve_hours_ago)
 
     fig.update_layout(
         title=f"Bitcoin Price (Last {HOURS} Hours)",
@@ -74,19 +178,34 @@ def update_graph(n):
     )
     return fig
 
-def update_reddit_graph(n):
+def refresh_reddit_data():
     global reddit_data
-    if reddit_data.empty:
-        reddit_data = fetch_initial_reddit_comments(HOURS)
+    if not needs_refresh('reddit') or not acquire_refresh_lock(reddit_lock, reddit_data):
+        return reddit_data
+    try:
+        if not needs_refresh('reddit'):
+            return reddit_data
+        if reddit_data.empty:
+            reddit_data = fetch_initial_reddit_comments(HOURS)
 
-    new_data = fetch_new_reddit_data(reddit_data)
-    if new_data is not None and not new_data.empty:
-        reddit_data = pd.concat([reddit_data, new_data], ignore_index=True)
+        new_data = fetch_new_reddit_data(reddit_data)
+        if new_data is not None and not new_data.empty:
+            reddit_data = pd.concat([reddit_data, new_data], ignore_index=True)
 
-    now = datetime.utcnow()
-    hours_ago = now - timedelta(hours=HOURS)
-    reddit_data['date'] = reddit_data['date'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-    reddit_data = reddit_data[reddit_data['date'] >= hours_ago]
+        if not reddit_data.empty:
+            hours_ago = datetime.utcnow() - timedelta(hours=HOURS)
+            # New frames only, callbacks may still be rendering the previous snapshot
+            reddit_data = reddit_data.assign(date=pd.to_datetime(reddit_data['date']))
+            reddit_data = reddit_data.drop_duplicates(subset=['date']).sort_values('date')
+            reddit_data = reddit_data[reddit_data['date'] >= hours_ago]
+        last_refresh['reddit'] = datetime.utcnow()
+        return reddit_data
+    finally:
+        reddit_lock.release()
+
+def update_reddit_graph(n):
+    reddit_data = refresh_reddit_data()
+    hours_ago = datetime.utcnow() - timedelta(hours=HOURS)
 
     if reddit_data.empty:
         return go.Figure().update_layout(title="No data available")
@@ -99,6 +218,7 @@ def update_reddit_graph(n):
         name='Sentiment compound mean',
         line=dict(color='red')
     ))
+    add_alert_annotations(fig, ['positive_count', 'negative_count', 'compound_mean'], hours_ago)
 
     fig.update_layout(
         title=f"Sentiment Compound (Last {HOURS} Hours)",
@@ -148,9 +268,17 @@ def update_reddit_callback(n):
 scheduler = BackgroundScheduler()
 def scheduled_job():
     logging.info("Executing scheduled job")
-    send_whatsapp_rebit_message(bitcoin_data, reddit_data)
+    # The caches only follow the viewers, refresh them so that the summary
+    # is built from current data whichever worker enqueues it first
+    queued = enqueue_rebit_message(notification_queue, refresh_bitcoin_data(), refresh_reddit_data())
+    if queued == 0:
+        logging.warning("Daily summary not queued: no data, no subscribers or already queued by another worker")
+    else:
+        logging.info(f"Daily summary queued for {queued} subscribers")
 
-scheduler.add_job(scheduled_job, 'interval', hours=24)
+# Fixed time of day, so the job of every worker maps to the same daily schedule id
+scheduler.add_job(scheduled_job, 'cron', hour=int(os.getenv('SUMMARY_HOUR_UTC', 8)), timezone='UTC')
+scheduler.add_job(detect_anomalies, 'interval', seconds=ANOMALY_POLL_SECONDS, next_run_time=datetime.now())
 scheduler.start()
 
 # Run the App
@@ -0,0 +1,365 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import botocore
+import requests
+import numpy as np
+import pandas as pd
+
+from io import BytesIO
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'BUCKET')
+CALLBACKS = [
+    ('bitcoin-graph', 'figure'),
+    ('reddit-graph', 'figure'),
+]
+
+
+class LocalS3Client:
+    """
+    Fake S3 client serving the objects of a local folder.
+
+    Implements the calls used by `utils` (list_objects_v2, get_object with
+    IfNoneMatch, put_object) with an optional latency per call, so the
+    dashboard can be loaded without touching the real bucket.
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, root:str, latency:float=0.0):
+        self.root = root
+        self.latency = latency
+
+    def _path(self, key:str):
+        return os.path.join(self.root, key)
+
+    def list_objects_v2(self, Bucket:str, Prefix:str):
+        time.sleep(self.latency)
+        folder, name_prefix = os.path.split(self._path(Prefix))
+        if not os.path.isdir(folder):
+            return {}
+        contents = [
+            {
+                'Key': os.path.relpath(os.path.join(folder, name), self.root),
+                'LastModified': datetime.utcfromtimestamp(os.path.getmtime(os.path.join(folder, name))),
+            }
+            for name in sorted(os.listdir(folder))
+            if name.startswith(name_prefix) and os.path.isfile(os.path.join(folder, name))
+        ]
+        return {'Contents': contents} if contents else {}
+
+    def get_object(self, Bucket:str, Key:str, IfNoneMatch:str=None):
+        time.sleep(self.latency)
+        path = self._path(Key)
+        if not os.path.exists(path):
+            raise self.exceptions.NoSuchKey(Key)
+        with open(path, 'rb') as file:
+            body = file.read()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if IfNoneMatch == etag:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'Body': BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Bucket:str, Key:str, Body, **kwargs):
+        time.sleep(self.latency)
+        path = self._path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, readers never see a partial object
+        with open(path + '.tmp', 'wb') as file:
+            file.write(Body.encode('utf-8') if isinstance(Body, str) else Body)
+        os.replace(path + '.tmp', path)
+        return {}
+
+
+def write_fake_object(s3:LocalS3Client, df:pd.DataFrame, source:str, written:datetime, time_column:str):
+    """Store `df` as the object of `source` written at `written` and record it in the manifest"""
+    file_key = written.strftime(f"{source}/coins_%Y%m%d_%H%M%S.csv")
+    s3.put_object(Bucket=utils.BUCKET_NAME, Key=file_key, Body=df.to_csv(index=False))
+    manifest_key = f"manifests/{source}.json"
+    try:
+        manifest = json.loads(s3.get_object(Bucket=utils.BUCKET_NAME, Key=manifest_key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        manifest = {'hours': {}}
+    times = pd.to_datetime(df[time_column])
+    manifest['hours'].setdefault(written.strftime('%Y%m%d_%H'), []).append({
+        'key': file_key,
+        'rows': len(df),
+        'written': written.strftime('%Y-%m-%d %H:%M:%S'),
+        'min_ts': times.min().strftime('%Y-%m-%d %H:%M:%S'),
+        'max_ts': times.max().strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    manifest['latest_key'] = file_key
+    manifest['latest_written'] = written.strftime('%Y-%m-%d %H:%M:%S')
+    s3.put_object(Bucket=utils.BUCKET_NAME, Key=manifest_key, Body=json.dumps(manifest))
+
+def seed_fake_store(root:str, hours:int=12, minutes:int=10):
+    """
+    Fill `root` with price and comment objects for the last `hours` hours.
+
+    Prices and comments are taken from the samples in BUCKET/ and re-dated
+    every `minutes` minutes up to now, with their manifests.
+    """
+    s3 = LocalS3Client(root)
+    prices = pd.read_csv(os.path.join(SAMPLE_DIR, 'bitcoin_data.csv'))
+    comments = pd.read_csv(os.path.join(SAMPLE_DIR, 'bitcoin_reddit_comments.csv'))
+    now = datetime.utcnow().replace(microsecond=0)
+    steps = hours * 60 // minutes
+    chunk = max(1, len(comments) // steps)
+    for step in range(steps):
+        written = now - timedelta(minutes=minutes * (steps - step))
+        sample = prices.iloc[(3 * step) % len(prices):(3 * step) % len(prices) + 3].copy()
+        sample['date'] = written.strftime('%Y-%m-%d %H:%M:%S')
+        write_fake_object(s3, sample, 'coins', written, 'date')
+        sample = comments.iloc[(chunk * step) % len(comments):(chunk * step) % len(comments) + chunk].copy()
+        sample['created_utc'] = written.strftime('%Y-%m-%d %H:%M:%S')
+        write_fake_object(s3, sample, 'reddit_comments', written, 'created_utc')
+    return root
+
+def load_app(root:str, latency:float=0.0):
+    """Import the dashboard with its S3 client replaced by a `LocalS3Client` over `root`"""
+    utils.get_s3_client = lambda: LocalS3Client(root, latency)
+    os.environ['REBIT_QUEUE_PATH'] = os.path.join(root, 'notifications.db')
+    import app
+    # Alerts raised by the fake data must not reach WhatsApp
+    app.dispatcher.send = lambda recipient, message, key: logging.info("Alert not sent (load test)")
+    return app
+
+
+def serve(root:str, port:int, workers:int=1, threads:int=1, latency:float=0.0):
+    """Run the dashboard under gunicorn against the fake store"""
+    from gunicorn.app.base import BaseApplication
+
+    class DashboardApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"127.0.0.1:{port}")
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread' if threads > 1 else 'sync')
+            self.cfg.set('timeout', 120)
+
+        def load(self):
+            return load_app(root, latency).server
+
+    DashboardApplication().run()
+
+
+def callback_payload(output_id:str, output_property:str, n_intervals:int):
+    return {
+        'output': f"{output_id}.{output_property}",
+        'outputs': {'id': output_id, 'property': output_property},
+        'inputs': [{'id': 'interval-component', 'property': 'n_intervals', 'value': n_intervals}],
+        'changedPropIds': ['interval-component.n_intervals'],
+        'state': [],
+    }
+
+def simulate_viewer(base_url:str, deadline:float, interval:float, results:list, lock):
+    """One browser: load the page, then fire both callbacks on every interval tick until `deadline`"""
+    session = requests.Session()
+    n_intervals = 0
+    for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+        try:
+            session.get(base_url + path, timeout=30)
+        except requests.RequestException:
+            pass
+    while time.monotonic() < deadline:
+        tick = time.monotonic()
+        for output_id, output_property in CALLBACKS:
+            start = time.perf_counter()
+            try:
+                response = session.post(
+                    base_url + '/_dash-update-component',
+                    json=callback_payload(output_id, output_property, n_intervals),
+                    timeout=60
+                )
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                results.append((output_id, time.perf_counter() - start, ok))
+        n_intervals += 1
+        time.sleep(max(0.0, interval - (time.monotonic() - tick)))
+
+def run_load(base_url:str, viewers:int=10, duration:float=30, interval:float=1.0):
+    """
+    Simulate `viewers` browsers on a running dashboard.
+
+    Returns
+    -------
+    dict
+        Number of callback requests, error rate, throughput (requests/s)
+        and p50/p95/p99 latency in milliseconds.
+    """
+    results = []
+    lock = threading.Lock()
+    start = time.monotonic()
+    deadline = start + duration
+    with ThreadPoolExecutor(max_workers=viewers) as executor:
+        for _ in range(viewers):
+            executor.submit(simulate_viewer, base_url, deadline, interval, results, lock)
+    elapsed = time.monotonic() - start
+    latencies = np.array([latency for _, latency, ok in results if ok]) * 1000
+    errors = sum(1 for _, _, ok in results if not ok)
+    return {
+        'viewers': viewers,
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'throughput': round(len(results) / elapsed, 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 1) if len(latencies) else None,
+        'p95_ms': round(float(np.percentile(latencies, 95)), 1) if len(latencies) else None,
+        'p99_ms': round(float(np.percentile(latencies, 99)), 1) if len(latencies) else None,
+    }
+
+def wait_until_up(base_url:str, timeout:float=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(base_url + '/_dash-layout', timeout=5).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+def sweep(configs:list, viewers:int, duration:float, interval:float, latency:float, port:int=8765, hours:int=12):
+    """
+    Load the dashboard once per (workers, threads) configuration.
+
+    Each configuration is served by a gunicorn subprocess over a freshly
+    seeded fake store, so that every run starts with cold caches.
+    """
+    report = []
+    for workers, threads in configs:
+        with tempfile.TemporaryDirectory() as root:
+            seed_fake_store(root, hours)
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'serve', '--store', root, '--port', str(port),
+                 '--workers', str(workers), '--threads', str(threads), '--latency', str(latency)],
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            try:
+                base_url = f"http://127.0.0.1:{port}"
+                if not wait_until_up(base_url):
+                    raise RuntimeError(f"Dashboard did not start with {workers} workers x {threads} threads")
+                stats = run_load(base_url, viewers, duration, interval)
+            finally:
+                process.terminate()
+                process.wait()
+        stats = {'workers': workers, 'threads': threads, **stats}
+        logging.info(json.dumps(stats))
+        report.append(stats)
+    return pd.DataFrame(report)
+
+
+def check_thread_safety(threads:int=16, iterations:int=20, hours:int=3, latency:float=0.005):
+    """
+    Hammer the dashboard callbacks from many threads while new objects arrive.
+
+    Runs in process against a fake store with `REFRESH_SECONDS = 0`, so every
+    call refreshes the shared data. Checks that no call fails and that the
+    shared price and sentiment data keep unique, sorted dates.
+
+    Returns
+    -------
+    dict
+        Calls made, errors and the invariants that do not hold (empty if safe).
+    """
+    with tempfile.TemporaryDirectory() as root:
+        seed_fake_store(root, hours)
+        app = load_app(root, latency)
+        app.REFRESH_SECONDS = 0
+        s3 = LocalS3Client(root)
+        stop = threading.Event()
+
+        def writer():
+            written = datetime.utcnow().replace(microsecond=0)
+            prices = pd.read_csv(os.path.join(SAMPLE_DIR, 'bitcoin_data.csv')).iloc[:3]
+            comments = pd.read_csv(os.path.join(SAMPLE_DIR, 'bitcoin_reddit_comments.csv')).iloc[:20]
+            while not stop.is_set():
+                written += timedelta(seconds=1)
+                write_fake_object(s3, prices.assign(date=written.strftime('%Y-%m-%d %H:%M:%S')), 'coins', written, 'date')
+                write_fake_object(s3, comments.assign(created_utc=written.strftime('%Y-%m-%d %H:%M:%S')), 'reddit_comments', written, 'created_utc')
+                time.sleep(0.01)
+
+        errors = []
+        def hammer(index):
+            for n in range(iterations):
+                try:
+                    app.update_graph(n)
+                    app.update_reddit_graph(n)
+                except Exception as e:
+                    errors.append(repr(e))
+
+        writer_thread = threading.Thread(target=writer, daemon=True)
+        writer_thread.start()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(hammer, range(threads)))
+        stop.set()
+        writer_thread.join()
+
+        violations = []
+        for name, df in (('bitcoin_data', app.bitcoin_data), ('reddit_data', app.reddit_data)):
+            if df.empty:
+                violations.append(f"{name} is empty")
+                continue
+            if df['date'].duplicated().any():
+                violations.append(f"{name} has duplicated dates")
+            if not pd.to_datetime(df['date']).is_monotonic_increasing:
+                violations.append(f"{name} dates are not sorted")
+        return {
+            'calls': 2 * threads * iterations,
+            'errors': len(errors),
+            'first_errors': errors[:5],
+            'violations': violations,
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Load test the dashboard against a local fake store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sweep_parser = subparsers.add_parser('sweep', help="Load every worker configuration and print the latencies")
+    sweep_parser.add_argument('--configs', default='1x1,1x4,2x4', help="Comma separated <workers>x<threads>")
+    sweep_parser.add_argument('--viewers', type=int, default=20)
+    sweep_parser.add_argument('--duration', type=float, default=30, help="Seconds of load per configuration")
+    sweep_parser.add_argument('--interval', type=float, default=1.0, help="Seconds between two ticks of a viewer")
+    sweep_parser.add_argument('--latency', type=float, default=0.02, help="Simulated S3 latency per call, in seconds")
+    sweep_parser.add_argument('--port', type=int, default=8765)
+
+    serve_parser = subparsers.add_parser('serve', help="Serve the dashboard over a fake store")
+    serve_parser.add_argument('--store', default=None, help="Fake store folder. Defaults to a seeded temporary one")
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--workers', type=int, default=1)
+    serve_parser.add_argument('--threads', type=int, default=1)
+    serve_parser.add_argument('--latency', type=float, default=0.02)
+
+    check_parser = subparsers.add_parser('check', help="Check the shared state under concurrent callbacks")
+    check_parser.add_argument('--threads', type=int, default=16)
+    check_parser.add_argument('--iterations', type=int, default=20)
+
+    args = parser.parse_args()
+    if args.command == 'sweep':
+        configs = [tuple(int(v) for v in config.split('x')) for config in args.configs.split(',')]
+        report = sweep(configs, args.viewers, args.duration, args.interval, args.latency, args.port)
+        print(report.to_string(index=False))
+    elif args.command == 'serve':
+        store = args.store or seed_fake_store(tempfile.mkdtemp())
+        serve(store, args.port, args.workers, args.threads, args.latency)
+    else:
+        result = check_thread_safety(args.threads, args.iterations)
+        print(json.dumps(result, indent=2))
+        sys.exit(1 if result['errors'] or result['violations'] else 0)
@@ -0,0 +1,363 @@
+import os
+import json
+import time
+import uuid
+import random
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+import requests
+
+from contextlib import closing
+from datetime import datetime
+
+WSP_API_URL = 'https://graph.facebook.com/v21.0'
+QUEUE_PATH = 'rebit_notifications.db'
+
+
+def get_subscribers():
+    """Recipients of the notifications, comma separated in `WSP_PHONE_TARGETS` (or `WSP_PHONE_TARGET`)"""
+    targets = os.getenv('WSP_PHONE_TARGETS') or os.getenv('WSP_PHONE_TARGET') or ''
+    return [target.strip() for target in targets.split(',') if target.strip()]
+
+def idempotency_key(schedule_id:str, recipient:str):
+    """Same key for the same schedule and recipient, whichever worker enqueues it"""
+    return hashlib.sha1(f"{schedule_id}:{recipient}".encode('utf-8')).hexdigest()
+
+
+class NotificationQueue:
+    """
+    Durable outbound queue of notifications, stored in SQLite.
+
+    One row per (schedule, recipient), unique on its idempotency key, so
+    every worker can enqueue the same schedule and a single delivery is
+    kept. The same database holds the leases used to elect the worker that
+    delivers, and the anomaly alerts detected by that worker so that every
+    worker can draw them.
+
+    Parameters
+    ----------
+    path : str, optional
+        SQLite file shared by the workers. Defaults to the environment
+        variable `REBIT_QUEUE_PATH`, or 'rebit_notifications.db'.
+    """
+
+    def __init__(self, path:str=None):
+        self.path = path or os.getenv('REBIT_QUEUE_PATH', QUEUE_PATH)
+        with closing(self._connect()) as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    idempotency_key TEXT PRIMARY KEY,
+                    schedule_id TEXT NOT NULL,
+                    recipient TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    claimed_at REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS alerts (
+                    alert_id TEXT PRIMARY KEY,
+                    date TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    value REAL,
+                    zscore REAL,
+                    detector TEXT NOT NULL,
+                    direction TEXT NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, schedule_id:str, message:str, recipients:list=None):
+        """
+        Queue `message` for every recipient, once per `schedule_id`.
+
+        Returns
+        -------
+        int
+            Number of deliveries added, 0 if the schedule was already queued.
+        """
+        recipients = get_subscribers() if recipients is None else recipients
+        now = time.time()
+        rows = [
+            (idempotency_key(schedule_id, recipient), schedule_id, recipient, message, now, now)
+            for recipient in recipients
+        ]
+        with closing(self._connect()) as con:
+            before = con.total_changes
+            con.executemany(
+                "INSERT OR IGNORE INTO deliveries "
+                "(idempotency_key, schedule_id, recipient, message, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            return con.total_changes - before
+
+    def claim_due(self, limit:int=50, stale_seconds:float=300):
+        """
+        Mark up to `limit` due deliveries as 'sending' and return them.
+
+        Deliveries left in 'sending' for `stale_seconds` (the process died
+        mid-delivery) are due again.
+        """
+        now = time.time()
+        with closing(self._connect()) as con:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                rows = con.execute(
+                    "SELECT idempotency_key, recipient, message, attempts FROM deliveries "
+                    "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                    "OR (status = 'sending' AND claimed_at <= ?) "
+                    "ORDER BY next_attempt_at LIMIT ?",
+                    (now, now - stale_seconds, limit)
+                ).fetchall()
+                con.executemany(
+                    "UPDATE deliveries SET status = 'sending', claimed_at = ? WHERE idempotency_key = ?",
+                    [(now, row[0]) for row in rows]
+                )
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+        return [
+            {'idempotency_key': key, 'recipient': recipient, 'message': message, 'attempts': attempts}
+            for key, recipient, message, attempts in rows
+        ]
+
+    def mark_sent(self, key:str):
+        with closing(self._connect()) as con:
+            con.execute(
+                "UPDATE deliveries SET status = 'sent', attempts = attempts + 1, last_error = NULL "
+                "WHERE idempotency_key = ?",
+                (key,)
+            )
+
+    def mark_failed(self, key:str, error:str, retry_at:float=None):
+        """Record a failed attempt, retried at `retry_at` or given up ('dead') when None"""
+        with closing(self._connect()) as con:
+            con.execute(
+                "UPDATE deliveries SET status = ?, attempts = attempts + 1, last_error = ?, "
+                "next_attempt_at = COALESCE(?, next_attempt_at) WHERE idempotency_key = ?",
+                ('pending' if retry_at is not None else 'dead', error, retry_at, key)
+            )
+
+    def counts(self):
+        """Number of deliveries per status"""
+        with closing(self._connect()) as con:
+            return dict(con.execute("SELECT status, count(*) FROM deliveries GROUP BY status").fetchall())
+
+    def acquire_lease(self, name:str, owner:str, ttl:float=60):
+        """
+        Take or renew the lease `name` for `owner` during `ttl` seconds.
+
+        Returns True if `owner` holds the lease, i.e. it is the leader.
+        """
+        now = time.time()
+        with closing(self._connect()) as con:
+            con.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now)
+            )
+            row = con.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def add_alerts(self, alerts:list):
+        """Store alert events (dicts with an 'alert_id'), once per id. Returns the number added"""
+        rows = [
+            (
+                alert['alert_id'], alert['date'].strftime('%Y-%m-%d %H:%M:%S'), alert['metric'],
+                alert['value'], alert['zscore'], alert['detector'], alert['direction']
+            )
+            for alert in alerts
+        ]
+        with closing(self._connect()) as con:
+            before = con.total_changes
+            con.executemany("INSERT OR IGNORE INTO alerts VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            return con.total_changes - before
+
+    def recent_alerts(self, since:datetime):
+        """Alert events dated after `since`, oldest first"""
+        with closing(self._connect()) as con:
+            rows = con.execute(
+                "SELECT date, metric, value, zscore, detector, direction FROM alerts "
+                "WHERE date >= ? ORDER BY date",
+                (since.strftime('%Y-%m-%d %H:%M:%S'),)
+            ).fetchall()
+        return [
+            {
+                'date': datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
+                'metric': metric,
+                'value': value,
+                'zscore': zscore,
+                'detector': detector,
+                'direction': direction,
+            }
+            for date, metric, value, zscore, detector, direction in rows
+        ]
+
+
+class DeliveryError(Exception):
+    """Failed delivery, `retryable` is False when retrying cannot help (e.g. a 400)"""
+
+    def __init__(self, message:str, retryable:bool=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def post_whatsapp_message(recipient:str, message:str, key:str, session:requests.Session=None, timeout:float=10):
+    """
+    Send one WhatsApp text message through the Graph API.
+
+    The endpoint is `WSP_API_URL` (overridable with the environment variable
+    of the same name, e.g. to point at a local fake), the idempotency key is
+    sent in the 'Idempotency-Key' header.
+
+    Raises
+    ------
+    DeliveryError
+        When the request fails, not retryable for 4xx answers other than 408/429.
+    """
+    url = f"{os.getenv('WSP_API_URL', WSP_API_URL)}/{os.getenv('WSP_PHONE')}/messages"
+    headers = {
+        "Authorization": f"Bearer {os.getenv('WSP_TOKEN')}",
+        "Content-Type": "application/json",
+        "Idempotency-Key": key
+    }
+    data = {
+        "messaging_product": "whatsapp",
+        "to": recipient,
+        "type": "text",
+        "text": {
+            "body": f'{message}'
+        }
+    }
+    try:
+        response = (session or requests).post(url, headers=headers, data=json.dumps(data), timeout=timeout)
+    except requests.RequestException as e:
+        raise DeliveryError(str(e))
+    if response.status_code >= 400:
+        retryable = response.status_code >= 500 or response.status_code in (408, 429)
+        raise DeliveryError(f"{response.status_code}: {response.text[:200]}", retryable)
+    return response
+
+
+class NotificationDispatcher:
+    """
+    Delivers the queued notifications from a background thread.
+
+    Every `poll_seconds` the dispatcher renews its lease; only the lease
+    holder (one worker among all the gunicorn workers sharing the queue)
+    claims the due deliveries and sends them concurrently, at most
+    `concurrency` at a time, on an asyncio loop. Failed deliveries are
+    retried with exponential backoff and jitter up to `max_attempts`.
+
+    Parameters
+    ----------
+    queue : NotificationQueue
+    send : callable, optional
+        Called as send(recipient, message, idempotency_key), raises on
+        failure. Defaults to `post_whatsapp_message`.
+    concurrency : int, optional
+        Maximum number of deliveries in flight. Defaults to 4.
+    max_attempts : int, optional
+        Attempts before a delivery is given up. Defaults to 5.
+    base_backoff : float, optional
+        Seconds before the first retry, doubled at each attempt. Defaults to 5.
+    poll_seconds : float, optional
+        Interval between two polls of the queue. Defaults to 5.
+    lease_name : str, optional
+        Name of the leader lease. Defaults to 'notification-dispatcher'.
+    """
+
+    def __init__(self,
+                 queue:NotificationQueue,
+                 send=post_whatsapp_message,
+                 concurrency:int=4,
+                 max_attempts:int=5,
+                 base_backoff:float=5,
+                 poll_seconds:float=5,
+                 lease_name:str='notification-dispatcher'):
+        self.queue = queue
+        self.send = send
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.poll_seconds = poll_seconds
+        self.lease_name = lease_name
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_leader(self):
+        return self.queue.acquire_lease(self.lease_name, self.owner, ttl=max(30, 6 * self.poll_seconds))
+
+    async def _deliver(self, delivery:dict, semaphore:asyncio.Semaphore):
+        async with semaphore:
+            try:
+                await asyncio.to_thread(self.send, delivery['recipient'], delivery['message'], delivery['idempotency_key'])
+            except Exception as e:
+                attempts = delivery['attempts'] + 1
+                retryable = getattr(e, 'retryable', True) and attempts < self.max_attempts
+                retry_at = None
+                if retryable:
+                    retry_at = time.time() + self.base_backoff * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+                self.queue.mark_failed(delivery['idempotency_key'], str(e), retry_at)
+                logging.warning(f"Delivery to {delivery['recipient']} failed (attempt {attempts}): {e}")
+                return False
+            self.queue.mark_sent(delivery['idempotency_key'])
+            return True
+
+    async def dispatch_once(self):
+        """
+        Deliver the due notifications if this dispatcher is the leader.
+
+        Returns
+        -------
+        dict
+            Number of deliveries sent and failed in this round.
+        """
+        if not self.is_leader():
+            return {'sent': 0, 'failed': 0}
+        deliveries = self.queue.claim_due()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._deliver(d, semaphore) for d in deliveries))
+        return {'sent': sum(results), 'failed': len(results) - sum(results)}
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                asyncio.run(self.dispatch_once())
+            except Exception as e:
+                logging.error(f"Notification dispatch failed: {e}")
+            self._stop.wait(self.poll_seconds)
+
+    def start(self):
+        """Run the dispatcher in a daemon thread"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='notification-dispatcher', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout:float=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,235 @@
+import os
+import glob
+import duckdb
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+BUCKET_NAME = 'bucket-iot-sentiment-analysis'
+
+# Stored objects are named <prefix>_YYYYMMDD_HHMMSS.<ext>
+TABLE_PREFIXES = {
+    'coins': 'coins/coins',
+    'reddit_comments': 'reddit_comments/coins',
+}
+# Tables whose coins other than Bitcoin are stored in a folder per coin,
+# e.g. 'reddit_comments/ethereum/coins_*', exposed in a `coin` column
+PER_COIN_TABLES = ('reddit_comments',)
+DEFAULT_COIN = 'bitcoin'
+FILE_TIME_SQL = "strptime(regexp_extract(filename, '(\\d{8}_\\d{6})\\.[a-z]+$', 1), '%Y%m%d_%H%M%S')"
+
+
+def get_duckdb_connection(root:str=None):
+    """
+    Create a DuckDB connection able to read the stored objects.
+
+    Parameters
+    ----------
+    root : str, optional
+        Local folder holding a copy of the bucket. When None the bucket is read
+        from S3 (or an S3-compatible store when `S3_ENDPOINT_URL` is set) with
+        the same credentials as `utils.get_s3_client`.
+
+    Returns
+    -------
+    duckdb.DuckDBPyConnection
+    """
+    con = duckdb.connect()
+    if root is None:
+        con.execute("INSTALL httpfs; LOAD httpfs;")
+        endpoint = os.getenv('S3_ENDPOINT_URL')
+        secret = [
+            "TYPE S3",
+            f"KEY_ID '{os.getenv('AWS_ACCESS_KEY_ID', '')}'",
+            f"SECRET '{os.getenv('AWS_SECRET_ACCESS_KEY', '')}'",
+            f"REGION '{os.getenv('AWS_DEFAULT_REGION', 'eu-west-2')}'",
+        ]
+        if endpoint:
+            use_ssl = endpoint.startswith('https://')
+            endpoint = endpoint.split('://', 1)[-1]
+            secret += [f"ENDPOINT '{endpoint}'", "URL_STYLE 'path'", f"USE_SSL {use_ssl}"]
+        con.execute(f"CREATE SECRET rebit_s3 ({', '.join(secret)})")
+    return con
+
+def _object_root(root:str=None):
+    if root is None:
+        return f"s3://{BUCKET_NAME}"
+    return root.rstrip('/')
+
+def _glob(con, pattern:str, root:str=None):
+    if root is None:
+        return [row[0] for row in con.execute("SELECT file FROM glob(?)", [pattern]).fetchall()]
+    return glob.glob(pattern)
+
+def list_partition_files(con, table:str, start:datetime, end:datetime, root:str=None):
+    """
+    List the objects of a table whose timestamped key falls in [start, end].
+
+    Only the daily key prefixes of the range are globbed, so months of data
+    are pruned down to the files of the requested days. For the tables of
+    `PER_COIN_TABLES` the per-coin folders are globbed too (re-scored
+    'lexicon-*' copies are skipped). The Parquet copy of an object is
+    preferred over its CSV when both exist.
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        Connection returned by `get_duckdb_connection`.
+    table : str
+        One of the keys of `TABLE_PREFIXES`.
+    start, end : datetime
+        Range of the object timestamps (UTC).
+    root : str, optional
+        Local copy of the bucket, see `get_duckdb_connection`.
+
+    Returns
+    -------
+    list of str
+        Paths or s3:// URLs of the matching objects.
+    """
+    prefix = f"{_object_root(root)}/{TABLE_PREFIXES[table]}"
+    prefixes = [prefix]
+    if table in PER_COIN_TABLES:
+        folder, name = prefix.rsplit('/', 1)
+        prefixes.append(f"{folder}/*/{name}")
+    # Object key without extension -> path of the copy read
+    objects = {}
+    day = datetime(start.year, start.month, start.day)
+    while day <= end:
+        for day_prefix in prefixes:
+            for path in _glob(con, day.strftime(f"{day_prefix}_%Y%m%d_*"), root):
+                stem, ext = path.rsplit('.', 1)
+                if ext not in ('parquet', 'csv'):
+                    continue
+                if os.path.basename(os.path.dirname(path)).startswith('lexicon-'):
+                    continue
+                if ext == 'parquet' or stem not in objects:
+                    objects[stem] = path
+        day += timedelta(days=1)
+    start_key = start.strftime('%Y%m%d_%H%M%S')
+    end_key = end.strftime('%Y%m%d_%H%M%S')
+    # Drop the files of the first and last day outside the time range
+    return sorted(
+        f for f in objects.values()
+        if start_key <= os.path.basename(f).split('_', 1)[-1].rsplit('.', 1)[0] <= end_key
+    )
+
+def register_table(con, table:str, start:datetime, end:datetime, root:str=None):
+    """
+    Register `table` as a SQL view over the objects of [start, end].
+
+    The view exposes the stored columns plus `file_time`, the timestamp
+    taken from the object key, and for the tables of `PER_COIN_TABLES`
+    `coin`, taken from the folder of the object (`DEFAULT_COIN` at the top
+    level). Returns False when no object matches, in which case the view is
+    not created.
+    """
+    files = list_partition_files(con, table, start, end, root)
+    if not files:
+        return False
+    file_list = ', '.join(f"'{f}'" for f in files)
+    if all(f.endswith('.parquet') for f in files):
+        source = f"read_parquet([{file_list}], filename=true, union_by_name=true)"
+    elif all(f.endswith('.csv') for f in files):
+        source = f"read_csv([{file_list}], filename=true, union_by_name=true, header=true)"
+    else:
+        parquet = ', '.join(f"'{f}'" for f in files if f.endswith('.parquet'))
+        csv = ', '.join(f"'{f}'" for f in files if f.endswith('.csv'))
+        source = (
+            f"(SELECT * FROM read_parquet([{parquet}], filename=true, union_by_name=true) "
+            f"UNION ALL BY NAME "
+            f"SELECT * FROM read_csv([{csv}], filename=true, union_by_name=true, header=true))"
+        )
+    excluded = ['filename']
+    columns = [f"{FILE_TIME_SQL} AS file_time"]
+    if table in PER_COIN_TABLES:
+        folder = TABLE_PREFIXES[table].rsplit('/', 1)[0]
+        columns.append(
+            f"coalesce(nullif(regexp_extract(filename, '{folder}/([^/]+)/[^/]+$', 1), ''), "
+            f"'{DEFAULT_COIN}') AS coin"
+        )
+        # Recent objects also store the coin, the folder gives it for all of them
+        stored = [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+        if 'coin' in stored:
+            excluded.append('coin')
+    con.execute(
+        f"CREATE OR REPLACE VIEW {table} AS "
+        f"SELECT * EXCLUDE ({', '.join(excluded)}), {', '.join(columns)} FROM {source}"
+    )
+    return True
+
+def query(sql:str, start:datetime, end:datetime=None, root:str=None, params:list=None, tables:list=None):
+    """
+    Run a SQL query over the `coins` and `reddit_comments` tables.
+
+    The tables are registered over the objects stored between `start` and
+    `end`; the query runs inside DuckDB and only its result is loaded into
+    pandas. Tables without objects in the range are not registered.
+
+    Parameters
+    ----------
+    sql : str
+        Query referencing `coins` and/or `reddit_comments`.
+    start : datetime
+        Start of the range (UTC).
+    end : datetime, optional
+        End of the range (UTC). Defaults to now.
+    root : str, optional
+        Local copy of the bucket, see `get_duckdb_connection`.
+    params : list, optional
+        Parameters bound to the `?` placeholders of `sql`.
+    tables : list of str, optional
+        Tables used by `sql`. Defaults to every table of `TABLE_PREFIXES`.
+
+    Returns
+    -------
+    Pandas DataFrame
+        The query result, empty if it uses a table that has no objects.
+    """
+    end = end or datetime.utcnow()
+    tables = TABLE_PREFIXES if tables is None else tables
+    con = get_duckdb_connection(root)
+    try:
+        missing = [table for table in tables if not register_table(con, table, start, end, root)]
+        try:
+            return con.execute(sql, params or []).df()
+        except duckdb.CatalogException as e:
+            # The query uses a table with no objects in the range
+            if any(table in str(e) for table in missing):
+                return pd.DataFrame()
+            raise
+    finally:
+        con.close()
+
+def fetch_bitcoin_prices(start:datetime, end:datetime=None, minutes:int=10, root:str=None):
+    """Mean Bitcoin USD price per `minutes` bucket, computed in DuckDB"""
+    sql = f"""
+        SELECT time_bucket(INTERVAL '{int(minutes)} minutes', CAST(date AS TIMESTAMP)) AS date,
+               avg(bitcoin) AS bitcoin
+        FROM coins
+        WHERE currency = 'usd'
+        GROUP BY 1
+        ORDER BY 1
+    """
+    return query(sql, start, end, root, tables=['coins'])
+
+def fetch_sentiment_counts(start:datetime, end:datetime=None, minutes:int=10, root:str=None, coin:str=None):
+    """
+    Sentiment counts per `minutes` bucket of the stored Reddit comments.
+
+    Same figures as `utils.comments2count`, aggregated in DuckDB over the
+    object timestamps so that only one row per bucket is loaded. Comments
+    of every coin are counted unless `coin` is given.
+    """
+    sql = f"""
+        SELECT time_bucket(INTERVAL '{int(minutes)} minutes', file_time) AS date,
+               count(*) FILTER (WHERE compound > 0.05) AS positive_count,
+               count(*) FILTER (WHERE compound < -0.05) AS negative_count,
+               count(*) FILTER (WHERE compound BETWEEN -0.05 AND 0.05) AS neutral_count,
+               avg(compound) AS compound_mean
+        FROM reddit_comments
+        {'WHERE coin = ?' if coin else ''}
+        GROUP BY 1
+        ORDER BY 1
+    """
+    return query(sql, start, end, root, params=[coin] if coin else None, tables=['reddit_comments'])
@@ -1,7 +1,8 @@
 import os 
+import re
 import json
 import boto3
-import requests
+import botocore
 import pandas as pd
 
 from io import StringIO
@@ -13,6 +14,8 @@ import logging
 
 BUCKET_NAME = 'bucket-iot-sentiment-analysis'
 HOURS = 3
+# source -> (ETag, manifest) of the last manifest read
+MANIFEST_CACHE = {}
 
 def get_s3_client():
     """Create and return an S3 client"""
@@ -25,20 +28,107 @@ def get_s3_client():
         aws_secret_access_key=SECRET_KEY,
         region_name=REGION
     )
+
+def fetch_manifest(s3, source:str):
+    """
+    Return the manifest maintained by the lambdas for `source`.
+
+    The GET is conditional on the ETag of the last manifest read, so an
+    unchanged manifest costs a 304 without body and the cached copy is
+    returned.
+
+    Parameters
+    ----------
+    s3 : boto3 S3 client
+    source : str
+        'coins' or 'reddit_comments'.
+
+    Returns
+    -------
+    dict or None
+        The manifest, None if the lambdas have not written it yet.
+    """
+    key = f"manifests/{source}.json"
+    cached = MANIFEST_CACHE.get(source)
+    conditions = {'IfNoneMatch': cached[0]} if cached else {}
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=key, **conditions)
+    except s3.exceptions.NoSuchKey:
+        return None
+    except botocore.exceptions.ClientError as e:
+        if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+            return cached[1]
+        raise
+    manifest = json.loads(response['Body'].read())
+    MANIFEST_CACHE[source] = (response['ETag'], manifest)
+    return manifest
+
+def manifest_entries(manifest:dict, since:datetime, field:str='written'):
+    """Entries of `manifest` whose `field` ('written', 'min_ts' or 'max_ts') is after `since`, oldest first"""
+    since_str = since.strftime('%Y-%m-%d %H:%M:%S')
+    entries = [
+        entry
+        for hour_entries in manifest['hours'].values()
+        for entry in hour_entries
+        if entry[field] is not None and entry[field] > since_str
+    ]
+    return sorted(entries, key=lambda entry: entry['written'])
+
+def manifest_start(manifest:dict):
+    """Write time of the oldest object in `manifest`, None if there is no manifest or it is empty"""
+    if manifest is None:
+        return None
+    written = [entry['written'] for hour_entries in manifest['hours'].values() for entry in hour_entries]
+    return datetime.strptime(min(written), '%Y-%m-%d %H:%M:%S') if written else None
+
+def objects_written_before(response:dict, before:datetime=None):
+    """Objects of a list_objects_v2 `response` whose key timestamp is before `before`, all of them when None"""
+    contents = response.get("Contents", [])
+    if before is None:
+        return contents
+    before_key = before.strftime('%Y%m%d_%H%M%S')
+    return [
+        obj for obj in contents
+        if (match := re.search(r'(\d{8}_\d{6})\.\w+$', obj["Key"])) and match.group(1) < before_key
+    ]
+
+def read_file_from_bucket(s3, file_key:str):
+    file_obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
+    csv_content = file_obj["Body"].read().decode("utf-8")
+    df = pd.read_csv(StringIO(csv_content))
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+    return df
+
 def fetch_initial_bitcoin_data(hours:int=3):
     """Fetch Bitcoin price data for the last `HOURS` hours once"""
     s3 = get_s3_client()
     twelve_hours_ago = datetime.utcnow() - timedelta(hours=hours)
     all_bitcoin_data = []
+    manifest = fetch_manifest(s3, 'coins')
+    if manifest is not None:
+        for entry in manifest_entries(manifest, twelve_hours_ago, field='max_ts'):
+            try:
+                df = read_file_from_bucket(s3, entry['key'])
+                usd_data = df[df["currency"] == "usd"]
+                if not usd_data.empty:
+                    all_bitcoin_data.append(usd_data)
+            except Exception as e:
+                logging.error(f"Error reading {entry['key']}: {e}")
+    # Objects written before the oldest manifest entry are listed instead
+    oldest = manifest_start(manifest)
     for hour_offset in range(hours + 1):
         target_time = twelve_hours_ago + timedelta(hours=hour_offset)
+        if oldest is not None and target_time.replace(minute=0, second=0, microsecond=0) >= oldest:
+            break
         for i in range(0, 60, 10):
             file_prefix = target_time.strftime("coins/coins_%Y%m%d_%H") + f"{i:02d}"
             try:
                 response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=file_prefix)
-                if "Contents" not in response:
+                contents = objects_written_before(response, oldest)
+                if not contents:
                     continue
-                latest_file = max(response["Contents"], key=lambda x: x["LastModified"])
+                latest_file = max(contents, key=lambda x: x["LastModified"])
                 file_key = latest_file["Key"]
                 file_obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
                 csv_content = file_obj["Body"].read().decode("utf-8")
@@ -66,6 +156,18 @@ def fetch_new_bitcoin_data(bitcoin_data: pd.DataFrame):
     file_prefix = now.strftime("coins/coins_%Y%m%d_%H")
     new_data = []
     try:
+        manifest = fetch_manifest(s3, 'coins')
+        if manifest is not None:
+            since = last_timestamp if last_timestamp is not None else now - timedelta(hours=1)
+            for entry in manifest_entries(manifest, since, field='max_ts'):
+                try:
+                    df = read_file_from_bucket(s3, entry['key'])
+                    usd_data = df[(df["currency"] == "usd") & (df['date'] > since)]
+                    if not usd_data.empty:
+                        new_data.append(usd_data)
+                except Exception as e:
+                    logging.error(f"Error reading {entry['key']}: {e}")
+            return pd.concat(new_data, ignore_index=True) if new_data else pd.DataFrame()
         response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=file_prefix)
         if "Contents" in response:
             df, last_file_time = read_last_modify_file_from_bucket(s3, response)
@@ -86,16 +188,36 @@ def fetch_initial_reddit_comments(hours:int=3, output:str='sentimets'):
     s3 = get_s3_client()
     hours_ago = datetime.utcnow() - timedelta(hours=hours)
     all_reddit_data = []
+    manifest = fetch_manifest(s3, 'reddit_comments')
+    if manifest is not None:
+        if output not in ('sentimets', 'comments'):
+            raise NotImplementedError
+        for entry in manifest_entries(manifest, hours_ago):
+            try:
+                df = read_file_from_bucket(s3, entry['key'])
+                if output == 'sentimets':
+                    df_dict = comments2count(df)
+                    df_dict['date'] = entry['written']
+                    all_reddit_data.append(pd.DataFrame(df_dict, index=[0]))
+                else:
+                    all_reddit_data.append(df)
+            except Exception as e:
+                logging.error(f"Error reading {entry['key']}: {e}")
+    # Objects written before the oldest manifest entry are listed instead
+    oldest = manifest_start(manifest)
     for hour_offset in range(hours + 1):
         target_time = hours_ago + timedelta(hours=hour_offset)
+        if oldest is not None and target_time.replace(minute=0, second=0, microsecond=0) >= oldest:
+            break
         for i in range(0, 60, 10):
             minutes = f"{i:02d}" if i < 10 else f"{i:01d}"[:1]
             file_prefix = target_time.strftime("reddit_comments/coins_%Y%m%d_%H") + minutes
             try:
                 response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=file_prefix)
-                if "Contents" not in response:
+                contents = objects_written_before(response, oldest)
+                if not contents:
                     continue
-                df, latest_file_time = read_last_modify_file_from_bucket(s3, response)
+                df, latest_file_time = read_last_modify_file_from_bucket(s3, {"Contents": contents})
                 if output == 'sentimets':
                     df_dict = comments2count(df)    
                     latest_file_time_str = f"{latest_file_time.strftime('%Y-%m-%d %H:%M:%S')}"
@@ -113,15 +235,11 @@ def fetch_initial_reddit_comments(hours:int=3, output:str='sentimets'):
     if all_reddit_data:
         combined_df = pd.concat(all_reddit_data, ignore_index=True)
         return combined_df
+    return pd.DataFrame()
     
 def read_last_modify_file_from_bucket(s3, response):
     latest_file = max(response["Contents"], key=lambda x: x["LastModified"])
-    file_key = latest_file["Key"]
-    file_obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
-    csv_content = file_obj["Body"].read().decode("utf-8")
-    df = pd.read_csv(StringIO(csv_content))
-    if 'date' in df.columns:
-        df['date'] = pd.to_datetime(df['date'])
+    df = read_file_from_bucket(s3, latest_file["Key"])
     return df, latest_file['LastModified']
 
 def comments2count(df):
@@ -141,13 +259,24 @@ def comments2count(df):
 def fetch_new_reddit_data(reddit_data: pd.DataFrame):
     """Fetch and append new Reddit data"""
     s3 = get_s3_client()
-    last_timestamp = reddit_data['date'].max() if not reddit_data.empty else None    
-    last_timestamp = datetime.strptime(last_timestamp, '%Y-%m-%d %H:%M:%S')
+    last_timestamp = pd.to_datetime(reddit_data['date']).max() if not reddit_data.empty else None
     
     now = datetime.utcnow()
     file_prefix = now.strftime("reddit_comments/coins_%Y%m%d_%H")
     new_data = []
     try:
+        manifest = fetch_manifest(s3, 'reddit_comments')
+        if manifest is not None:
+            since = last_timestamp if last_timestamp is not None else now - timedelta(hours=1)
+            for entry in manifest_entries(manifest, since):
+                try:
+                    df = read_file_from_bucket(s3, entry['key'])
+                    dict_feelings = comments2count(df)
+                    dict_feelings['date'] = entry['written']
+                    new_data.append(pd.DataFrame(dict_feelings, index=[0]))
+                except Exception as e:
+                    logging.error(f"Error reading {entry['key']}: {e}")
+            return pd.concat(new_data, ignore_index=True) if new_data else pd.DataFrame()
         response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=file_prefix)
         if "Contents" in response:
             df, latest_file_time = read_last_modify_file_from_bucket(s3, response)
@@ -163,40 +292,6 @@ def fetch_new_reddit_data(reddit_data: pd.DataFrame):
         return pd.concat(new_data, ignore_index=True)
     return pd.DataFrame()
 
-def send_whatsapp_message(message:str):
-    ACCESS_TOKEN = os.getenv('WSP_TOKEN')
-    PHONE_NUMBER_ID = os.getenv('WSP_PHONE')
-    RECIPIENT_PHONE_NUMBER = os.getenv('WSP_PHONE_TARGET')
-
-    # API URL
-    URL = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-
-    # Headers for the API request
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
-    # Data payload for custom text message
-    data = {
-        "messaging_product": "whatsapp",
-        "to": RECIPIENT_PHONE_NUMBER,
-        "type": "text",
-        "text": {
-            "body": f'{message}'
-        }
-    }
-
-    # Sending the POST request
-    response = requests.post(URL, headers=headers, data=json.dumps(data))
-
-    # Check and print the response
-    if response.status_code == 200:
-        logging.info(f"Message sent successfully: {response.json()}")
-    else:
-        logging.info("Message sent successfully", exc_info=response.json())
-        logging.info("Error:", exc_info=response.json())
-
 # weighted sum
 def compoud2index(compound:float):
     return (compound + 1) * 50
@@ -246,27 +341,62 @@ def get_bitcoin_message(last_price, initial_price):
     '''.format(last_price, sign, price_change_percentage)    
     return text
     
+METRIC_LABELS = {
+    'positive_count': 'Positive comments',
+    'negative_count': 'Negative comments',
+    'compound_mean': 'Sentiment compound',
+    'price_return': 'Bitcoin price return',
+}
+
+def get_anomaly_message(event:dict):
+    arrow = '📈' if event['direction'] == 'up' else '📉'
+    kind = 'Spike' if event['detector'] == 'zscore' else 'Sustained shift'
+    text = '''
+    🚨 ReBit Alert {}
+    🔹 {}: {} ({})
+    🔹 Value: {:.4g} (z-score {})
+    🔹 Time: {} UTC
+    '''.format(arrow, kind, METRIC_LABELS.get(event['metric'], event['metric']),
+               event['direction'], event['value'], event['zscore'],
+               event['date'].strftime('%Y-%m-%d %H:%M'))
+    return text
+
+def anomaly_alert_id(event:dict):
+    """Same id for the same alert event, used as its schedule id"""
+    return f"alert:{event['metric']}:{event['detector']}:{event['date'].strftime('%Y%m%d_%H%M%S')}"
+
+def enqueue_anomaly_alerts(queue, events:list):
+    """Queue one message per alert event, once per event whichever worker detected it"""
+    for event in events:
+        queue.enqueue(anomaly_alert_id(event), get_anomaly_message(event))
+    return len(events)
+
 def get_state_update_message():
     return '''Stay updated for more insights! 🚀'''
 
-def send_whatsapp_rebit_message(bitcoin_data:pd.DataFrame, sentiments_data:pd.DataFrame):
-    if bitcoin_data.empty or sentiments_data.empty:
-        return False
-    logging.info("send_whatsapp_rebit_message called")
+def get_rebit_message(bitcoin_data:pd.DataFrame, sentiments_data:pd.DataFrame):
+    """Daily summary message, None when there is no data to summarize"""
     if bitcoin_data.empty or sentiments_data.empty:
-        return
+        return None
     initial_price = bitcoin_data.iloc[0].bitcoin
     last_price = bitcoin_data.iloc[-1].bitcoin
     bitcoin_message = get_bitcoin_message(last_price, initial_price)
     fear_greed = get_fear_and_greed_index(sentiments_data)
     fear_greed_message = get_fear_and_greed_message(fear_greed)
-    message = bitcoin_message + fear_greed_message + get_state_update_message()
-    try:
-        send_whatsapp_message(message)
-        logging.info("Message sent successfully")
-    except Exception as e:
-        logging.error(f"Error sending message: {e}")
-    return
+    return bitcoin_message + fear_greed_message + get_state_update_message()
+
+def enqueue_rebit_message(queue, bitcoin_data:pd.DataFrame, sentiments_data:pd.DataFrame, day:str=None):
+    """
+    Queue the daily summary for every subscriber.
+
+    The schedule id is the day, so the summary is queued once per day even
+    when every gunicorn worker runs the scheduled job.
+    """
+    message = get_rebit_message(bitcoin_data, sentiments_data)
+    if message is None:
+        return 0
+    day = day or datetime.utcnow().strftime('%Y-%m-%d')
+    return queue.enqueue(f"daily-summary:{day}", message)
 
 def get_comments2sentiments_per_minutes(comments, minutes:int=10):
     # Ensure 'created_utc' is in datetime format
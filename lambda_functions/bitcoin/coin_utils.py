@@ -1,23 +1,59 @@
+import re
+import json
+import time
 import boto3
+import botocore
 import requests
 import pandas as pd
 from io import StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
-def fetch_crypto_prices(coins:list=['bitcoin', 'ethereum', 'solana', 'dogecoin', 'cardano']):
-    # Fetch prices for Bitcoin, Ethereum, Solana, Dogecoin, and Cardano
+COINGECKO_URL = 'https://api.coingecko.com/api/v3/simple/price'
+
+def fetch_crypto_prices(coins:list=['bitcoin', 'ethereum', 'solana', 'dogecoin', 'cardano'],
+                        session:requests.Session=None,
+                        url:str=COINGECKO_URL,
+                        timeout:float=10):
+    """
+    Fetch the current USD, EUR and GBP prices of `coins`.
+
+    Parameters
+    ----------
+    coins : list of str, optional
+        CoinGecko ids of the coins. Defaults to Bitcoin, Ethereum, Solana, Dogecoin and Cardano.
+    session : requests.Session, optional
+        Session reused across calls (see `init_price_session`). Defaults to a one-off request.
+    url : str, optional
+        Price endpoint, CoinGecko's /simple/price or a compatible fake. Defaults to `COINGECKO_URL`.
+    timeout : float, optional
+        Request timeout in seconds. Defaults to 10.
+
+    Returns
+    -------
+    Pandas DataFrame
+        One row per currency with one column per coin, the '<coin>_updated_at'
+        time the source last updated each coin and the 'date' of the request.
+    """
     coins_names = ','.join(coins)
-    url = 'https://api.coingecko.com/api/v3/simple/price'
     params = {
         'ids': coins_names,
-        'vs_currencies': 'usd,eur,gbp'
+        'vs_currencies': 'usd,eur,gbp',
+        'include_last_updated_at': 'true'
     }
-    response = requests.get(url, params=params)
+    response = (session or requests).get(url, params=params, timeout=timeout)
+    response.raise_for_status()
     coins_price = response.json()
+    updated_at = {
+        f"{coin}_updated_at": datetime.utcfromtimestamp(prices.pop('last_updated_at')).strftime('%Y-%m-%d %H:%M:%S')
+        for coin, prices in coins_price.items()
+        if 'last_updated_at' in prices
+    }
     coins_price = pd.DataFrame(coins_price)
     coins_price.index.name = 'currency'
     coins_price.reset_index(inplace=True)
+    for column, value in updated_at.items():
+        coins_price[column] = value
     utc_now = datetime.utcnow()
     time_str = f"{utc_now.strftime('%Y-%m-%d %H:%M:%S')}"
     coins_price['date'] = time_str
@@ -63,4 +99,93 @@ def store_df_in_bucket(df,
     return {
             "statusCode": 200,
             "body": f"CSV file successfully uploaded to {bucket_name}/{file_key}"
-        }
\ No newline at end of file
+        }
+
+MANIFEST_HOURS = 72
+
+def manifest_key(file_key:str):
+    """Return the key of the manifest indexing the objects stored next to `file_key`"""
+    return 'manifests/' + file_key.rsplit('/', 1)[0] + '.json'
+
+def update_manifest(df,
+                    file_key:str,
+                    time_column:str,
+                    bucket_name:str='bucket-iot-sentiment-analysis',
+                    bucket_location:str='eu-west-2',
+                    max_retries:int=5
+                    ):
+    """
+    Record a stored object in the manifest of its source.
+
+    The manifest is a small JSON object with the latest key and, for each of
+    the last `MANIFEST_HOURS` hours, the list of keys written with their row
+    count and min/max timestamp, so that readers get everything new with a
+    single GET instead of listing the bucket. It is updated with a
+    compare-and-swap (conditional PUT on the ETag read), retried when
+    another writer updated it in between.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The DataFrame stored at `file_key`.
+    file_key : str
+        The key of the stored object, with the timestamp added by
+        `include_time_in_filename`.
+    time_column : str
+        Column of `df` holding the row timestamps.
+    bucket_name : str, optional
+        The name of the S3 bucket. Default is 'bucket-iot-sentiment-analysis'.
+    bucket_location : str, optional
+        The AWS region of the S3 bucket. Default is 'eu-west-2'.
+    max_retries : int, optional
+        Number of attempts when the manifest is updated concurrently. Default is 5.
+
+    Returns
+    -------
+    dict
+        The manifest written.
+    """
+    st_client = boto3.client('s3', bucket_location)
+    key = manifest_key(file_key)
+    written = re.search(r'(\d{8}_\d{6})\.\w+$', file_key).group(1)
+    written = datetime.strptime(written, '%Y%m%d_%H%M%S')
+    times = pd.to_datetime(df[time_column]) if len(df) else pd.Series(dtype='datetime64[ns]')
+    entry = {
+        'key': file_key,
+        'rows': len(df),
+        'written': written.strftime('%Y-%m-%d %H:%M:%S'),
+        'min_ts': times.min().strftime('%Y-%m-%d %H:%M:%S') if len(times) else None,
+        'max_ts': times.max().strftime('%Y-%m-%d %H:%M:%S') if len(times) else None,
+    }
+    oldest_hour = (written - timedelta(hours=MANIFEST_HOURS)).strftime('%Y%m%d_%H')
+    for attempt in range(max_retries):
+        try:
+            response = st_client.get_object(Bucket=bucket_name, Key=key)
+            manifest = json.loads(response['Body'].read())
+            condition = {'IfMatch': response['ETag']}
+        except st_client.exceptions.NoSuchKey:
+            manifest = {'hours': {}}
+            condition = {'IfNoneMatch': '*'}
+        hour = written.strftime('%Y%m%d_%H')
+        entries = manifest['hours'].setdefault(hour, [])
+        if all(e['key'] != file_key for e in entries):
+            entries.append(entry)
+        manifest['hours'] = {h: e for h, e in manifest['hours'].items() if h >= oldest_hour}
+        if manifest.get('latest_written', '') <= entry['written']:
+            manifest['latest_key'] = file_key
+            manifest['latest_written'] = entry['written']
+        try:
+            st_client.put_object(
+                Bucket=bucket_name,
+                Key=key,
+                Body=json.dumps(manifest),
+                ContentType='application/json',
+                **condition
+            )
+            return manifest
+        except botocore.exceptions.ClientError as e:
+            # 412: updated since our read, 409: concurrent conditional write
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+    raise RuntimeError(f"Could not update {bucket_name}/{key} after {max_retries} attempts")
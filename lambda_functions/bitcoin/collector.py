@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import logging
+import argparse
+import requests
+import pandas as pd
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from coin_utils import (
+    COINGECKO_URL,
+    fetch_crypto_prices,
+    store_df_in_bucket,
+    include_time_in_filename,
+    update_manifest
+)
+
+
+def init_price_session(retries:int=3, backoff_factor:float=1.0):
+    """
+    Create a pooled HTTP session for the price source.
+
+    The connection is kept alive between polls and 429/5xx answers are
+    retried with exponential backoff, honouring Retry-After.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET',),
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def store_prices(df, file_key:str):
+    """Store a batch of prices in the bucket and record it in the manifest"""
+    response = store_df_in_bucket(df, file_key)
+    update_manifest(df, file_key, time_column='date')
+    return response
+
+
+class PriceCollector:
+    """
+    Long-running price collector.
+
+    Polls the price source every `poll_seconds`, buffers the samples in
+    memory and writes them every `flush_seconds` as one batched object,
+    in the same layout as the lambda (one row per currency per sample).
+    Failed polls are retried after an exponential backoff capped at
+    `max_backoff_seconds`. A failed flush keeps the buffer for the next
+    interval; the buffer is flushed on stop.
+
+    Parameters
+    ----------
+    coins : list of str, optional
+        CoinGecko ids of the coins. Defaults to the coins of `fetch_crypto_prices`.
+    poll_seconds : float, optional
+        Interval between two polls. Defaults to 15.
+    flush_seconds : float, optional
+        Interval between two flushes. Defaults to 600.
+    url : str, optional
+        Price endpoint. Defaults to `COINGECKO_URL`.
+    session : requests.Session, optional
+        Session used for the polls. Defaults to `init_price_session()`.
+    store : callable, optional
+        Called with (df, file_key) on each flush. Defaults to `store_prices`.
+    file_key : str, optional
+        Key of the batches, timestamped with `include_time_in_filename`
+        (see `next_file_key`).
+        Defaults to 'coins/coins.csv'.
+    max_backoff_seconds : float, optional
+        Upper bound of the wait after failed polls. Defaults to 300.
+    """
+
+    def __init__(self,
+                 coins:list=None,
+                 poll_seconds:float=15,
+                 flush_seconds:float=600,
+                 url:str=COINGECKO_URL,
+                 session:requests.Session=None,
+                 store=store_prices,
+                 file_key:str='coins/coins.csv',
+                 max_backoff_seconds:float=300):
+        self.coins = coins or ['bitcoin', 'ethereum', 'solana', 'dogecoin', 'cardano']
+        self.poll_seconds = poll_seconds
+        self.flush_seconds = flush_seconds
+        self.url = url
+        self.session = session or init_price_session()
+        self.store = store
+        self.file_key = file_key
+        self.max_backoff_seconds = max_backoff_seconds
+        self.buffer = []
+        self.failures = 0
+        self.last_file_key = None
+
+    def poll(self):
+        """Fetch one sample into the buffer, returns False if the poll failed"""
+        try:
+            sample = fetch_crypto_prices(self.coins, session=self.session, url=self.url)
+        except (requests.RequestException, ValueError) as e:
+            self.failures += 1
+            logging.warning(f"Price poll failed ({self.failures} in a row): {e}")
+            return False
+        self.failures = 0
+        self.buffer.append(sample)
+        return True
+
+    def next_file_key(self):
+        """
+        Timestamped key of the next batch, never the key of a previous batch.
+
+        Keys only go down to the second, so a flush in the same second as the
+        previous one (e.g. the final flush right after a periodic one) gets
+        the next free second instead of overwriting it.
+        """
+        file_key = include_time_in_filename(self.file_key)
+        if self.last_file_key is not None and file_key <= self.last_file_key:
+            last_time = re.search(r'(\d{8}_\d{6})\.\w+$', self.last_file_key).group(1)
+            last_time = datetime.strptime(last_time, '%Y%m%d_%H%M%S')
+            file_name, ext = self.file_key.split('.')
+            file_key = f"{file_name}_{(last_time + timedelta(seconds=1)).strftime('%Y%m%d_%H%M%S')}.{ext}"
+        self.last_file_key = file_key
+        return file_key
+
+    def flush(self, raise_errors:bool=False):
+        """
+        Store the buffered samples as one object.
+
+        A failed store is logged and the buffer is kept, so the samples are
+        retried on the next flush; it is raised instead when `raise_errors`
+        is set. Returns the store response, or None if empty or failed.
+        """
+        if not self.buffer:
+            return None
+        df = pd.concat(self.buffer, ignore_index=True)
+        file_key = self.next_file_key()
+        try:
+            response = self.store(df, file_key)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logging.error(f"Flush of {len(self.buffer)} samples to {file_key} failed, retrying next interval: {e}")
+            return None
+        logging.info(f"Flushed {len(self.buffer)} samples to {file_key}")
+        self.buffer = []
+        return response
+
+    def next_wait(self):
+        """Seconds until the next poll, backing off after failed polls"""
+        if self.failures == 0:
+            return self.poll_seconds
+        return min(self.max_backoff_seconds, self.poll_seconds * 2 ** self.failures)
+
+    def run(self, max_seconds:float=None, sleep=time.sleep):
+        """
+        Poll and flush until interrupted or `max_seconds` have elapsed.
+
+        Parameters
+        ----------
+        max_seconds : float, optional
+            Stop after this many seconds. Defaults to running forever.
+        sleep : callable, optional
+            Function used to wait between polls. Defaults to time.sleep.
+        """
+        start = time.monotonic()
+        last_flush = start
+        try:
+            while max_seconds is None or time.monotonic() - start < max_seconds:
+                poll_start = time.monotonic()
+                self.poll()
+                if time.monotonic() - last_flush >= self.flush_seconds:
+                    self.flush()
+                    last_flush = time.monotonic()
+                sleep(max(0.0, self.next_wait() - (time.monotonic() - poll_start)))
+        except KeyboardInterrupt:
+            logging.info("Collector interrupted")
+        finally:
+            # Last chance to store the buffer, fail loudly rather than drop it
+            self.flush(raise_errors=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Poll crypto prices and store them in batches")
+    parser.add_argument('--poll-seconds', type=float, default=float(os.getenv('PRICE_POLL_SECONDS', 15)))
+    parser.add_argument('--flush-seconds', type=float, default=float(os.getenv('PRICE_FLUSH_SECONDS', 600)))
+    parser.add_argument('--url', default=os.getenv('PRICE_API_URL', COINGECKO_URL))
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+    collector = PriceCollector(
+        poll_seconds=args.poll_seconds,
+        flush_seconds=args.flush_seconds,
+        url=args.url
+    )
+    collector.run(max_seconds=args.max_seconds)
@@ -4,7 +4,8 @@ from datetime import datetime
 from coin_utils import (
     fetch_crypto_prices,
     store_df_in_bucket,
-    include_time_in_filename
+    include_time_in_filename,
+    update_manifest
 )
 
 def lambda_handler(event, context):
@@ -13,4 +14,5 @@ def lambda_handler(event, context):
     save_in = 'coins/coins.csv'
     save_in = include_time_in_filename(save_in)
     response = store_df_in_bucket(df_coins, save_in)
+    update_manifest(df_coins, save_in, time_column='date')
     return response
\ No newline at end of file
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import time
+import boto3
+import hashlib
+import logging
+import argparse
+import pandas as pd
+from io import StringIO
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import (
+    init_finance_sentiment_analyzer,
+    add_sentiments_to_df,
+    store_df_in_bucket
+)
+
+SCORE_COLUMNS = ['neg', 'neu', 'pos', 'compound']
+OBJECT_PATTERN = re.compile(r'^reddit_comments/(?:(?!lexicon-)[^/]+/)?coins_(\d{8}_\d{6})\.csv$')
+
+# Set in each worker process by `init_worker`
+_analyzer = None
+_s3 = None
+
+
+def lexicon_version(financial_terms_yaml:str):
+    """Short hash of the financial lexicon, so every lexicon gets its own outputs"""
+    with open(financial_terms_yaml, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()[:8]
+
+def rescored_key(file_key:str, version:str):
+    """Key of the re-scored copy of `file_key`, in a 'lexicon-<version>' folder next to it"""
+    folder, name = file_key.rsplit('/', 1)
+    return f"{folder}/lexicon-{version}/{name}"
+
+def list_comment_objects(s3, bucket_name:str, start:datetime, end:datetime):
+    """
+    List the stored comment objects written between `start` and `end`.
+
+    Both the Bitcoin objects ('reddit_comments/coins_*') and the ones of the
+    other coins ('reddit_comments/<coin>/coins_*') are returned, re-scored
+    copies are skipped. Only the daily key prefixes of the range are
+    listed, so earlier backfill outputs and days out of range are never
+    paginated.
+    """
+    start_key = start.strftime('%Y%m%d_%H%M%S')
+    end_key = end.strftime('%Y%m%d_%H%M%S')
+    paginator = s3.get_paginator('list_objects_v2')
+    folders = ['reddit_comments/']
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='reddit_comments/', Delimiter='/'):
+        folders += [
+            prefix['Prefix'] for prefix in page.get('CommonPrefixes', [])
+            if not prefix['Prefix'].rsplit('/', 2)[-2].startswith('lexicon-')
+        ]
+    keys = []
+    day = datetime(start.year, start.month, start.day)
+    while day <= end:
+        for folder in folders:
+            prefix = day.strftime(f"{folder}coins_%Y%m%d")
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    match = OBJECT_PATTERN.match(obj['Key'])
+                    if match and start_key <= match.group(1) <= end_key:
+                        keys.append(obj['Key'])
+        day += timedelta(days=1)
+    return sorted(keys)
+
+def load_checkpoint(path:str):
+    """Keys already re-scored by a previous run, empty if there is no checkpoint"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as file:
+        return {line.strip() for line in file if line.strip()}
+
+def save_checkpoint(file, file_key:str):
+    # One key per line, appended and flushed as soon as the object is done;
+    # a line cut by an interruption only re-scores that object again
+    file.write(file_key + '\n')
+    file.flush()
+
+def init_worker(financial_terms_yaml:str, bucket_location:str):
+    global _analyzer, _s3
+    _analyzer = init_finance_sentiment_analyzer(financial_terms_yaml)
+    _s3 = boto3.client('s3', bucket_location)
+
+def rescore_object(file_key:str, version:str, bucket_name:str, bucket_location:str):
+    """Re-score one stored object in a worker process and write its versioned copy"""
+    start = time.perf_counter()
+    file_obj = _s3.get_object(Bucket=bucket_name, Key=file_key)
+    df = pd.read_csv(StringIO(file_obj['Body'].read().decode('utf-8')))
+    df = df.drop(columns=[c for c in SCORE_COLUMNS if c in df.columns])
+    df[['title', 'body']] = df[['title', 'body']].fillna('').astype(str)
+    df = add_sentiments_to_df(df.reset_index(drop=True), _analyzer)
+    store_df_in_bucket(df, rescored_key(file_key, version), bucket_name, bucket_location)
+    return file_key, len(df), time.perf_counter() - start
+
+def backfill(start:datetime,
+             end:datetime,
+             financial_terms_yaml:str='financial_terms.yaml',
+             version:str=None,
+             checkpoint:str=None,
+             workers:int=None,
+             bucket_name:str='bucket-iot-sentiment-analysis',
+             bucket_location:str='eu-west-2'):
+    """
+    Re-score the stored comments written between `start` and `end`.
+
+    Objects are re-scored with the current financial lexicon across a
+    process pool and written to 'lexicon-<version>' folders next to the
+    originals. Finished keys are checkpointed, so running the same command
+    again resumes where an interrupted run stopped.
+
+    Parameters
+    ----------
+    start, end : datetime
+        Range of the object timestamps (UTC).
+    financial_terms_yaml : str, optional
+        Lexicon passed to `init_finance_sentiment_analyzer`. Defaults to 'financial_terms.yaml'.
+    version : str, optional
+        Version of the outputs. Defaults to a hash of the lexicon file.
+    checkpoint : str, optional
+        Checkpoint file, one finished key per line. Defaults to 'backfill_<version>.txt'.
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    bucket_name : str, optional
+        The name of the S3 bucket. Default is 'bucket-iot-sentiment-analysis'.
+    bucket_location : str, optional
+        The AWS region of the S3 bucket. Default is 'eu-west-2'.
+
+    Returns
+    -------
+    dict
+        Objects and rows re-scored, objects skipped from the checkpoint,
+        failures, elapsed seconds and rows per second.
+    """
+    version = version or lexicon_version(financial_terms_yaml)
+    checkpoint = checkpoint or f"backfill_{version}.txt"
+    s3 = boto3.client('s3', bucket_location)
+    keys = list_comment_objects(s3, bucket_name, start, end)
+    done = load_checkpoint(checkpoint)
+    todo = [key for key in keys if key not in done]
+    logging.info(f"{len(keys)} objects in range, {len(keys) - len(todo)} already done, version {version}")
+    stats = {'version': version, 'objects': 0, 'rows': 0, 'skipped': len(keys) - len(todo), 'failed': 0}
+    start_time = time.perf_counter()
+    with open(checkpoint, 'a') as checkpoint_file, \
+         ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(financial_terms_yaml, bucket_location)) as executor:
+        futures = {
+            executor.submit(rescore_object, key, version, bucket_name, bucket_location): key
+            for key in todo
+        }
+        for future in as_completed(futures):
+            try:
+                file_key, rows, _ = future.result()
+            except Exception as e:
+                stats['failed'] += 1
+                logging.error(f"Error re-scoring {futures[future]}: {e}")
+                continue
+            save_checkpoint(checkpoint_file, file_key)
+            stats['objects'] += 1
+            stats['rows'] += rows
+            elapsed = time.perf_counter() - start_time
+            logging.info(f"{stats['objects']}/{len(todo)} objects, {stats['rows'] / elapsed:.1f} rows/s")
+    stats['seconds'] = round(time.perf_counter() - start_time, 3)
+    stats['rows_per_second'] = round(stats['rows'] / stats['seconds'], 2) if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Re-score the stored Reddit comments with the current lexicon")
+    parser.add_argument('--start', required=True, help="Start date, YYYY-MM-DD")
+    parser.add_argument('--end', default=None, help="End date included, YYYY-MM-DD. Defaults to today")
+    parser.add_argument('--financial-terms', default='financial_terms.yaml')
+    parser.add_argument('--version', default=None)
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    end = datetime.strptime(args.end, '%Y-%m-%d') if args.end else datetime.utcnow()
+    end = datetime(end.year, end.month, end.day) + timedelta(days=1) - timedelta(seconds=1)
+    stats = backfill(
+        start,
+        end,
+        financial_terms_yaml=args.financial_terms,
+        version=args.version,
+        checkpoint=args.checkpoint,
+        workers=args.workers
+    )
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,199 @@
+import re
+import zlib
+import hashlib
+import numpy as np
+from collections import deque, Counter
+from utils import read_yaml
+
+# Mersenne prime 2**31 - 1, keeps a * x + b inside uint64 for 31 bit hashes
+MERSENNE_PRIME = (1 << 31) - 1
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+')
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def normalize_text(text:str):
+    """Lowercase `text`, drop its links and collapse punctuation and whitespace"""
+    text = URL_PATTERN.sub(' ', text.lower())
+    return ' '.join(WORD_PATTERN.findall(text))
+
+def shingles(text:str, size:int=3):
+    """Set of word `size`-grams of a normalized text"""
+    words = text.split()
+    if len(words) < size:
+        return {text} if text else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class NearDuplicateFilter:
+    """
+    Streaming filter dropping spam, exact duplicates and near duplicates.
+
+    Rows are checked in order against:
+
+    - author, URL and text rules (regular expressions, case insensitive),
+    - the SHA-1 of the normalized text of the last `window` kept rows,
+    - MinHash signatures of the last `window` kept rows, bucketed with LSH
+      (`bands` x `rows_per_band` hashes). Candidates sharing a band are
+      dropped when their estimated Jaccard similarity is >= `threshold`.
+
+    State is bounded: once `window` rows are kept the oldest one is evicted
+    from the hash set and the LSH buckets. Texts shorter than `min_length`
+    characters (after normalization) only go through the rules, short
+    replies such as "yes" are legitimate when repeated.
+
+    Parameters
+    ----------
+    window : int, optional
+        Number of kept rows remembered for duplicate detection. Defaults to 5000.
+    threshold : float, optional
+        Jaccard similarity from which a row is a near duplicate. Defaults to 0.8.
+    bands, rows_per_band : int, optional
+        LSH layout, the signature has `bands * rows_per_band` hashes. Defaults to 16 x 8.
+    min_length : int, optional
+        Minimum normalized text length for duplicate detection. Defaults to 20.
+    blocked_authors : list of str, optional
+        Authors whose rows are always dropped.
+    blocked_url_patterns, blocked_text_patterns : list of str, optional
+        Regular expressions matched against the row URL and text.
+    seed : int, optional
+        Seed of the MinHash permutations. Defaults to 42.
+    """
+
+    def __init__(self,
+                 window:int=5000,
+                 threshold:float=0.8,
+                 bands:int=16,
+                 rows_per_band:int=8,
+                 min_length:int=20,
+                 blocked_authors:list=None,
+                 blocked_url_patterns:list=None,
+                 blocked_text_patterns:list=None,
+                 seed:int=42):
+        self.window = window
+        self.threshold = threshold
+        self.bands = bands
+        self.rows_per_band = rows_per_band
+        self.min_length = min_length
+        self.blocked_authors = {author.lower() for author in blocked_authors or []}
+        self.blocked_url = [re.compile(p, re.IGNORECASE) for p in blocked_url_patterns or []]
+        self.blocked_text = [re.compile(p, re.IGNORECASE) for p in blocked_text_patterns or []]
+        rng = np.random.default_rng(seed)
+        num_perm = bands * rows_per_band
+        self._a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._kept = deque()
+        self._hashes = set()
+        self._buckets = {}
+        self.stats = Counter()
+
+    def signature(self, text:str):
+        """MinHash signature of a normalized text"""
+        hashes = np.array(
+            [zlib.crc32(s.encode('utf-8')) & MERSENNE_PRIME for s in shingles(text)],
+            dtype=np.uint64
+        )
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def _band_keys(self, signature):
+        r = self.rows_per_band
+        return [(band, signature[band * r:(band + 1) * r].tobytes()) for band in range(self.bands)]
+
+    def _rule_match(self, author:str, url:str, text:str):
+        if author.lower() in self.blocked_authors:
+            return 'author'
+        if any(p.search(url) for p in self.blocked_url):
+            return 'url'
+        if any(p.search(text) for p in self.blocked_text):
+            return 'text'
+        return None
+
+    def _is_near_duplicate(self, signature, band_keys):
+        for key in band_keys:
+            for candidate in self._buckets.get(key, ()):
+                if np.mean(candidate == signature) >= self.threshold:
+                    return True
+        return False
+
+    def _remember(self, text_hash:str, signature, band_keys):
+        self._kept.append((text_hash, signature, band_keys))
+        self._hashes.add(text_hash)
+        for key in band_keys:
+            self._buckets.setdefault(key, []).append(signature)
+        if len(self._kept) > self.window:
+            old_hash, old_signature, old_keys = self._kept.popleft()
+            self._hashes.discard(old_hash)
+            for key in old_keys:
+                bucket = self._buckets[key]
+                # Buckets are in insertion order, the evicted row is first
+                bucket.pop(0)
+                if not bucket:
+                    del self._buckets[key]
+
+    def check(self, title:str, body:str='', author:str='', url:str=''):
+        """
+        Check one row and update the filter state.
+
+        Returns
+        -------
+        str or None
+            The reason the row is dropped ('author', 'url', 'text', 'exact'
+            or 'near'), or None if the row is kept.
+        """
+        text = f"{title} {body}"
+        reason = self._rule_match(str(author), str(url), text)
+        if reason is None:
+            normalized = normalize_text(text)
+            if len(normalized) >= self.min_length:
+                text_hash = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+                if text_hash in self._hashes:
+                    reason = 'exact'
+                else:
+                    signature = self.signature(normalized)
+                    band_keys = self._band_keys(signature)
+                    if self._is_near_duplicate(signature, band_keys):
+                        reason = 'near'
+                    else:
+                        self._remember(text_hash, signature, band_keys)
+        self.stats['rows'] += 1
+        self.stats[f'dropped_{reason}' if reason else 'kept'] += 1
+        return reason
+
+    def filter_df(self, df):
+        """
+        Keep the rows of `df` that are neither spam nor duplicates.
+
+        Parameters
+        ----------
+        df : Pandas DataFrame
+            DataFrame with the columns 'title', 'body', 'author' and 'url'.
+
+        Returns
+        -------
+        df : Pandas DataFrame
+            The kept rows, with a fresh index.
+        stats : dict
+            Number of rows read, kept and dropped per reason for this call.
+        """
+        before = Counter(self.stats)
+        if df.empty:
+            return df, {'rows': 0, 'kept': 0, 'dropped': 0}
+        keep = [
+            self.check(row.title, row.body, row.author, row.url) is None
+            for row in df[['title', 'body', 'author', 'url']].fillna('').itertuples(index=False)
+        ]
+        stats = dict(self.stats - before)
+        stats.setdefault('kept', 0)
+        stats['dropped'] = stats['rows'] - stats['kept']
+        return df[keep].reset_index(drop=True), stats
+
+
+def init_dedup_filter(filters_yaml:str="filters.yaml"):
+    """
+    Initialize a NearDuplicateFilter from the settings of a YAML file.
+
+    Every key of the file is passed as keyword argument, see
+    `NearDuplicateFilter` for the available settings.
+    """
+    settings = read_yaml(filters_yaml) or {}
+    return NearDuplicateFilter(**settings)
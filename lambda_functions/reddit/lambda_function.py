@@ -2,6 +2,7 @@ import yaml
 import praw
 import json
 import boto3
+import logging
 import pandas as pd
 from io import StringIO
 from utils import (
@@ -9,20 +10,50 @@ from utils import (
     test_csv_bucket_store, 
     store_df_in_bucket, 
     get_lasts_posts, 
-    include_time_in_filename
+    include_time_in_filename,
+    read_ingestion_config,
+    shard_pairs,
+    get_lasts_posts_for_pairs,
+    comments_file_key,
+    update_manifest
 )
+from dedup import init_dedup_filter
+
+# One filter per coin, kept across warm invocations so duplicates of the
+# previous runs are dropped too (the state is bounded by its window)
+DEDUP_FILTERS = {}
 
 def lambda_handler(event, context):
     bucket_name = 'bucket-iot-sentiment-analysis'
     bucket_location = 'eu-west-2'
     key_yaml = 'keys/reddit.yaml'
-    df = get_lasts_posts(key_yaml, 
-                        subreddit_name="all", 
-                        query="Bitcoin", 
-                        since_minutes=10, 
-                        limit=10000
-                        )
-    save_in = 'reddit_comments/coins.csv'
-    save_in = include_time_in_filename(save_in)
-    status_code = store_df_in_bucket(df, save_in)
-    return status_code
\ No newline at end of file
+    ingestion_yaml = 'ingestion.yaml'
+    # Parallel invocations each take one shard of the ingestion config
+    event = event or {}
+    num_shards = int(event.get('num_shards', 1))
+    shard_index = int(event.get('shard_index', 0))
+    pairs = read_ingestion_config(ingestion_yaml)
+    pairs = shard_pairs(pairs, num_shards, shard_index)
+    df, stats = get_lasts_posts_for_pairs(key_yaml,
+                                          pairs,
+                                          since_minutes=10,
+                                          limit=10000,
+                                          max_workers=int(event.get('max_workers', 8))
+                                          )
+    logging.info(f"Shard {shard_index}/{num_shards} stats: {json.dumps(stats)}")
+    responses = []
+    coins = df.groupby('coin') if not df.empty else []
+    stats['dedup'] = {}
+    for coin, df_coin in coins:
+        if coin not in DEDUP_FILTERS:
+            DEDUP_FILTERS[coin] = init_dedup_filter('filters.yaml')
+        df_coin, stats['dedup'][coin] = DEDUP_FILTERS[coin].filter_df(df_coin)
+        logging.info(f"Dropped {stats['dedup'][coin]['dropped']} {coin} rows: {stats['dedup'][coin]}")
+        save_in = include_time_in_filename(comments_file_key(coin))
+        responses.append(store_df_in_bucket(df_coin, save_in))
+        update_manifest(df_coin, save_in, time_column='created_utc')
+    return {
+            "statusCode": 200,
+            "body": [response["body"] for response in responses],
+            "stats": stats
+        }
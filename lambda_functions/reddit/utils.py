@@ -1,9 +1,13 @@
 import praw
 import yaml
+import re
 import json
+import time
 import boto3
+import botocore
 import pandas as pd
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 def store_df_in_bucket(
@@ -151,9 +155,6 @@ def get_lasts_posts(key_yaml:str,
         A DataFrame containing the fetched posts and their metadata. The columns include the post title, author, URL, creation time, upvotes, type (title or comment), and the number of comments.
     """
     reddit = init_reddit(key_yaml)  
-    # Define the subreddit and query
-    subreddit_name = "all"  # Replace with your subreddit of choice
-    query = "Bitcoin"  # Search keyword
     # Search subreddit for posts
     subreddit = reddit.subreddit(subreddit_name)
     posts = subreddit.search(query, sort="new", limit=limit)  # Adjust limit as needed
@@ -189,9 +190,156 @@ def get_lasts_posts(key_yaml:str,
                     'comments':None
                 }
                 main_posts.append(commment_dict)
+        else:
+            # Results are sorted by "new", everything after this is older
+            break
     df = pd.DataFrame(main_posts)
     return df
 
+def read_ingestion_config(ingestion_yaml:str="ingestion.yaml"):
+    """
+    Read the subreddit/query pairs to follow for each coin.
+
+    Parameters
+    ----------
+    ingestion_yaml : str, optional
+        Path to the YAML file mapping each coin to a list of
+        {subreddit, query} entries. Defaults to 'ingestion.yaml'.
+
+    Returns
+    -------
+    list of dict
+        One dictionary per pair with the keys 'coin', 'subreddit' and 'query'.
+    """
+    config = read_yaml(ingestion_yaml)
+    pairs = []
+    for coin, entries in config.items():
+        for entry in entries:
+            pairs.append({
+                'coin': coin,
+                'subreddit': entry['subreddit'],
+                'query': entry['query']
+            })
+    return pairs
+
+def shard_pairs(pairs:list, num_shards:int=1, shard_index:int=0):
+    """
+    Select the subreddit/query pairs assigned to one shard.
+
+    Coins are balanced by pair count: taken from the most to the least
+    pairs (then by name), each coin goes to the shard with the fewest pairs
+    so far. All the pairs of a coin land on the same shard, so its rows can
+    be deduplicated without looking at the output of the other shards, and
+    every invocation computes the same assignment from the same config.
+
+    Parameters
+    ----------
+    pairs : list of dict
+        Pairs as returned by `read_ingestion_config`.
+    num_shards : int, optional
+        Total number of shards (parallel invocations). Defaults to 1.
+    shard_index : int, optional
+        Index of the shard to select, in [0, num_shards). Defaults to 0.
+
+    Returns
+    -------
+    list of dict
+        The pairs belonging to `shard_index`.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be in [0, {num_shards}), got {shard_index}")
+    pairs_per_coin = {}
+    for pair in pairs:
+        pairs_per_coin[pair['coin']] = pairs_per_coin.get(pair['coin'], 0) + 1
+    load = [0] * num_shards
+    coin_shard = {}
+    for coin in sorted(pairs_per_coin, key=lambda coin: (-pairs_per_coin[coin], coin)):
+        shard = load.index(min(load))
+        coin_shard[coin] = shard
+        load[shard] += pairs_per_coin[coin]
+    return [pair for pair in pairs if coin_shard[pair['coin']] == shard_index]
+
+def _fetch_pair_posts(key_yaml:str, pair:dict, since_minutes:int, limit:int):
+    # Each worker gets its own praw instance, praw.Reddit is not thread-safe
+    start = time.perf_counter()
+    df = get_lasts_posts(key_yaml,
+                        subreddit_name=pair['subreddit'],
+                        query=pair['query'],
+                        since_minutes=since_minutes,
+                        limit=limit
+                        )
+    elapsed = time.perf_counter() - start
+    if not df.empty:
+        df['coin'] = pair['coin']
+    return df, elapsed
+
+def get_lasts_posts_for_pairs(key_yaml:str,
+                              pairs:list,
+                              since_minutes:int=30,
+                              limit=1000,
+                              max_workers:int=8):
+    """
+    Fetch the last posts of several subreddit/query pairs in parallel.
+
+    Parameters
+    ----------
+    key_yaml : str
+        Path to the YAML file containing the Reddit API credentials.
+    pairs : list of dict
+        Pairs as returned by `read_ingestion_config` or `shard_pairs`.
+    since_minutes : int, optional
+        The time limit in minutes. Defaults to 30.
+    limit : int, optional
+        The maximum number of posts to fetch per pair. Defaults to 1000.
+    max_workers : int, optional
+        Number of pairs fetched concurrently. Defaults to 8.
+
+    Returns
+    -------
+    df : Pandas DataFrame
+        The posts of every pair, merged and deduplicated per coin, with an
+        additional 'coin' column.
+    stats : dict
+        Throughput of the shard: number of pairs, rows fetched, rows kept
+        after deduplication, elapsed seconds and rows per second, plus the
+        same figures for every pair under 'pairs_stats'.
+    """
+    start = time.perf_counter()
+    frames = []
+    pair_stats = []
+    if pairs:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pairs))) as executor:
+            futures = [
+                executor.submit(_fetch_pair_posts, key_yaml, pair, since_minutes, limit)
+                for pair in pairs
+            ]
+            for pair, future in zip(pairs, futures):
+                df, elapsed = future.result()
+                frames.append(df)
+                pair_stats.append({
+                    **pair,
+                    'rows': len(df),
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(len(df) / elapsed, 2) if elapsed > 0 else 0.0
+                })
+    frames = [df for df in frames if not df.empty]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    rows_fetched = len(df)
+    if not df.empty:
+        # The same post is often matched by several queries of the same coin
+        df = df.drop_duplicates(subset=['coin', 'url', 'created_utc', 'title'])
+        df = df.reset_index(drop=True)
+    elapsed = time.perf_counter() - start
+    stats = {
+        'pairs': len(pairs),
+        'rows_fetched': rows_fetched,
+        'rows': len(df),
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(len(df) / elapsed, 2) if elapsed > 0 else 0.0,
+        'pairs_stats': pair_stats
+    }
+    return df, stats
+
 def include_time_in_filename(filename:str):
     """
     Append the current UTC timestamp to a given filename.
@@ -215,6 +363,17 @@ def include_time_in_filename(filename:str):
     save_in = file_name + '_' + time_str + '.' + ext
     return save_in
 
+def comments_file_key(coin:str='bitcoin'):
+    """
+    Return the (untimestamped) bucket key where the comments of a coin are stored.
+
+    Bitcoin keeps the original 'reddit_comments/coins.csv' layout read by the
+    dashboard, every other coin gets its own folder under 'reddit_comments/'.
+    """
+    if coin == 'bitcoin':
+        return 'reddit_comments/coins.csv'
+    return f'reddit_comments/{coin}/coins.csv'
+
 def init_finance_sentiment_analyzer(financial_terms_yaml:str="financial_terms.yaml"):
     # Initialize the VADER sentiment analyzer
     """
@@ -272,4 +431,93 @@ def add_sentiments_to_df(df, analyzer, analyzer_type='vader'):
         sentiments.append(scores)
     sentiments = pd.DataFrame(sentiments)
     df  = pd.concat([df, sentiments], axis=1)
-    return df
\ No newline at end of file
+    return df
+
+MANIFEST_HOURS = 72
+
+def manifest_key(file_key:str):
+    """Return the key of the manifest indexing the objects stored next to `file_key`"""
+    return 'manifests/' + file_key.rsplit('/', 1)[0] + '.json'
+
+def update_manifest(df,
+                    file_key:str,
+                    time_column:str,
+                    bucket_name:str='bucket-iot-sentiment-analysis',
+                    bucket_location:str='eu-west-2',
+                    max_retries:int=5
+                    ):
+    """
+    Record a stored object in the manifest of its source.
+
+    The manifest is a small JSON object with the latest key and, for each of
+    the last `MANIFEST_HOURS` hours, the list of keys written with their row
+    count and min/max timestamp, so that readers get everything new with a
+    single GET instead of listing the bucket. It is updated with a
+    compare-and-swap (conditional PUT on the ETag read), retried when
+    another writer updated it in between.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        The DataFrame stored at `file_key`.
+    file_key : str
+        The key of the stored object, with the timestamp added by
+        `include_time_in_filename`.
+    time_column : str
+        Column of `df` holding the row timestamps.
+    bucket_name : str, optional
+        The name of the S3 bucket. Default is 'bucket-iot-sentiment-analysis'.
+    bucket_location : str, optional
+        The AWS region of the S3 bucket. Default is 'eu-west-2'.
+    max_retries : int, optional
+        Number of attempts when the manifest is updated concurrently. Default is 5.
+
+    Returns
+    -------
+    dict
+        The manifest written.
+    """
+    st_client = boto3.client('s3', bucket_location)
+    key = manifest_key(file_key)
+    written = re.search(r'(\d{8}_\d{6})\.\w+$', file_key).group(1)
+    written = datetime.strptime(written, '%Y%m%d_%H%M%S')
+    times = pd.to_datetime(df[time_column]) if len(df) else pd.Series(dtype='datetime64[ns]')
+    entry = {
+        'key': file_key,
+        'rows': len(df),
+        'written': written.strftime('%Y-%m-%d %H:%M:%S'),
+        'min_ts': times.min().strftime('%Y-%m-%d %H:%M:%S') if len(times) else None,
+        'max_ts': times.max().strftime('%Y-%m-%d %H:%M:%S') if len(times) else None,
+    }
+    oldest_hour = (written - timedelta(hours=MANIFEST_HOURS)).strftime('%Y%m%d_%H')
+    for attempt in range(max_retries):
+        try:
+            response = st_client.get_object(Bucket=bucket_name, Key=key)
+            manifest = json.loads(response['Body'].read())
+            condition = {'IfMatch': response['ETag']}
+        except st_client.exceptions.NoSuchKey:
+            manifest = {'hours': {}}
+            condition = {'IfNoneMatch': '*'}
+        hour = written.strftime('%Y%m%d_%H')
+        entries = manifest['hours'].setdefault(hour, [])
+        if all(e['key'] != file_key for e in entries):
+            entries.append(entry)
+        manifest['hours'] = {h: e for h, e in manifest['hours'].items() if h >= oldest_hour}
+        if manifest.get('latest_written', '') <= entry['written']:
+            manifest['latest_key'] = file_key
+            manifest['latest_written'] = entry['written']
+        try:
+            st_client.put_object(
+                Bucket=bucket_name,
+                Key=key,
+                Body=json.dumps(manifest),
+                ContentType='application/json',
+                **condition
+            )
+            return manifest
+        except botocore.exceptions.ClientError as e:
+            # 412: updated since our read, 409: concurrent conditional write
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+    raise RuntimeError(f"Could not update {bucket_name}/{key} after {max_retries} attempts")